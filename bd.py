@@ -1,8 +1,85 @@
 #!/usr/bin/env python3
+import argparse
+import contextlib
+import contextvars
+import csv
+import functools
+import io
+import json
+import logging
+import queue
 import sqlite3
-from contextlib import closing
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from cache import TTLCache
+import metrics
+import tracing
 import os
 DATABASE_NAME = os.environ["DATABASE_NAME"]
+# Общие настройки соединения для server.py, notify-bot.py и check_for_recurrent.py
+DATABASE_BUSY_TIMEOUT = int(os.environ.get("DATABASE_BUSY_TIMEOUT", 5000))  # ms
+DATABASE_SYNCHRONOUS = os.environ.get("DATABASE_SYNCHRONOUS", "NORMAL")
+DATABASE_CACHE_SIZE = int(os.environ.get("DATABASE_CACHE_SIZE", -16000))  # KiB if < 0
+DATABASE_MMAP_SIZE = int(os.environ.get("DATABASE_MMAP_SIZE", 64 * 1024 * 1024))
+DATABASE_CACHED_STATEMENTS = int(os.environ.get("DATABASE_CACHED_STATEMENTS", 128))
+# Кэш чтений по первичному ключу. Записи этого процесса сбрасывают его сразу,
+# записи других процессов становятся видны не позже чем через TTL.
+DATABASE_ROW_CACHE_SIZE = int(os.environ.get("DATABASE_ROW_CACHE_SIZE", 10000))
+DATABASE_ROW_CACHE_TTL = float(os.environ.get("DATABASE_ROW_CACHE_TTL", 5))
+
+# Групповая запись: записи, накопившиеся пока идёт предыдущий коммит (плюс
+# ожидание до MAX_DELAY секунд, не больше MAX_ROWS строк), фиксируются одной
+# транзакцией. DURABLE=0 - не ждать коммита (при падении процесса теряется
+# последняя несохранённая пачка).
+DATABASE_BATCH_WRITES = os.environ.get("DATABASE_BATCH_WRITES", "0") == "1"
+DATABASE_BATCH_MAX_ROWS = int(os.environ.get("DATABASE_BATCH_MAX_ROWS", 256))
+DATABASE_BATCH_MAX_DELAY = float(os.environ.get("DATABASE_BATCH_MAX_DELAY", 0))
+DATABASE_BATCH_DURABLE = os.environ.get("DATABASE_BATCH_DURABLE", "1") == "1"
+
+logger = logging.getLogger(__name__)
+
+row_cache = TTLCache(DATABASE_ROW_CACHE_SIZE, DATABASE_ROW_CACHE_TTL)
+
+DB_LATENCY = metrics.Histogram(
+    "db_query_duration_seconds", "Duration of bd.py queries by function")
+metrics.Counter("db_row_cache_hits_total", "Row cache hits", lambda: row_cache.hits)
+metrics.Counter("db_row_cache_misses_total", "Row cache misses", lambda: row_cache.misses)
+
+
+def timed(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with DB_LATENCY.time(query=func.__name__), tracing.span(f"db.{func.__name__}"):
+            return func(*args, **kwargs)
+    return wrapper
+
+_local = threading.local()
+
+
+def _connect(**kwargs):
+    conn = sqlite3.connect(DATABASE_NAME,
+                           timeout=DATABASE_BUSY_TIMEOUT / 1000,
+                           cached_statements=DATABASE_CACHED_STATEMENTS, **kwargs)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute(f'PRAGMA synchronous = {DATABASE_SYNCHRONOUS}')
+    conn.execute(f'PRAGMA busy_timeout = {DATABASE_BUSY_TIMEOUT}')
+    conn.execute(f'PRAGMA cache_size = {DATABASE_CACHE_SIZE}')
+    conn.execute(f'PRAGMA mmap_size = {DATABASE_MMAP_SIZE}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
+
+
+def get_connection():
+    """Долгоживущее соединение текущего потока (пересоздаётся после fork)"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.pid != os.getpid():
+        conn = _connect()
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
 
 
 def dict_factory(cursor, row):
@@ -10,147 +87,855 @@ def dict_factory(cursor, row):
     return {key: value for key, value in zip(fields, row)}
 
 
-def update_subscription_success(time, payment_id):
-    """Обновление подписки при успешном платеже"""
-    with closing(sqlite3.connect(DATABASE_NAME)) as conn:
-        conn.execute('''
+class BatchWriter:
+    """Фоновый поток, который коммитит накопленные записи одной транзакцией"""
+    def __init__(self, max_rows: int, max_delay: float):
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="bd-batch-writer",
+                                       daemon=True)
+        self.thread.start()
+
+    def submit(self, sql, params, cache_key=None) -> Future:
+        future = Future()
+        self.queue.put((sql, params, cache_key, future))
+        return future
+
+    def close(self):
+        """Дописывает очередь и останавливает поток"""
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_rows:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._commit(batch)
+                    return
+                batch.append(item)
+            self._commit(batch)
+
+    def _commit(self, batch):
+        conn = get_connection()
+        try:
+            with conn, DB_LATENCY.time(query='batch_commit'):
+                start = 0
+                # подряд идущие одинаковые запросы - одним executemany, порядок сохраняется
+                for end in range(1, len(batch) + 1):
+                    if end == len(batch) or batch[end][0] != batch[start][0]:
+                        conn.executemany(batch[start][0],
+                                         [item[1] for item in batch[start:end]])
+                        start = end
+        except sqlite3.Error:
+            # одна плохая строка не должна ронять всю пачку
+            for item in batch:
+                self._commit_one(conn, item)
+            return
+        for sql, params, cache_key, future in batch:
+            if cache_key is not None:
+                row_cache.invalidate(cache_key)
+            future.set_result(None)
+
+    def _commit_one(self, conn, item):
+        sql, params, cache_key, future = item
+        try:
+            with conn:
+                conn.execute(sql, params)
+        except sqlite3.Error as e:
+            logger.error(f"Batched write failed: {e}")
+            future.set_exception(e)
+            return
+        if cache_key is not None:
+            row_cache.invalidate(cache_key)
+        future.set_result(None)
+
+
+batch_writer = (BatchWriter(DATABASE_BATCH_MAX_ROWS, DATABASE_BATCH_MAX_DELAY)
+                if DATABASE_BATCH_WRITES else None)
+
+
+# Futures записей, отправленных в batch_writer внутри deferred_writes()
+_deferred = contextvars.ContextVar('deferred_writes', default=None)
+
+
+@contextlib.contextmanager
+def deferred_writes():
+    """Записи через batch_writer не ждут коммита, а собираются в список
+    futures - так bd_async ждёт их в event loop, не занимая поток"""
+    futures = []
+    token = _deferred.set(futures)
+    try:
+        yield futures
+    finally:
+        _deferred.reset(token)
+
+
+def _write(sql, params, cache_key=None):
+    """Запись одной строки: сразу или через batch_writer"""
+    if batch_writer is not None:
+        future = batch_writer.submit(sql, params, cache_key)
+        if (deferred := _deferred.get()) is not None:
+            deferred.append(future)
+        elif DATABASE_BATCH_DURABLE:
+            future.result()
+        return
+    with get_connection() as conn:
+        conn.execute(sql, params)
+    if cache_key is not None:
+        row_cache.invalidate(cache_key)
+
+
+# Состояния подписки и допустимые переходы: состояние -> в какие можно перейти.
+#   active           - ждёт следующего периода (next_due_at)
+#   charging         - списание взято репликой планировщика (аренда до lease_expires)
+#   awaiting_webhook - шлюз принял платёж charge_id, результат придёт вебхуком;
+#                      next_due_at - когда перепроверить, если вебхук потерялся
+#   retry_scheduled  - списание не прошло, повтор в next_due_at
+#   suspended        - списания остановлены (способ оплаты не сохранён,
+#                      исчерпаны попытки)
+SUBSCRIPTION_TRANSITIONS = {
+    'active': ('charging', 'suspended'),
+    'charging': ('charging', 'active', 'awaiting_webhook', 'retry_scheduled', 'suspended'),
+    'awaiting_webhook': ('charging', 'active', 'retry_scheduled', 'suspended'),
+    'retry_scheduled': ('charging', 'suspended'),
+    'suspended': ('active',),
+}
+# состояния, в которых next_due_at означает срок действия планировщика
+SUBSCRIPTION_DUE_STATES = ('active', 'awaiting_webhook', 'retry_scheduled')
+
+
+def _entering(state):
+    """SQL-список состояний, из которых разрешён переход в state"""
+    return ", ".join(f"'{source}'" for source, targets in SUBSCRIPTION_TRANSITIONS.items()
+                     if state in targets)
+
+
+def _states(states):
+    return ", ".join(f"'{state}'" for state in states)
+
+
+def _owned(worker):
+    """Условие на владельца аренды: планировщик (worker) меняет только
+    подписку, которую держит сам, вебхук (None) - любую"""
+    return ('', ()) if worker is None else (' AND claimed_by = ?', (worker,))
+
+
+# Переходы выполняются условным UPDATE: если подписка уже в другом состоянии
+# (вебхук пришёл раньше ответа шлюза) или аренду забрала другая реплика,
+# строка не меняется. worker - имя реплики, взявшей подписку в
+# claim_due_subscriptions; вебхуки передают None.
+@timed
+def update_subscription_success(time, payment_id, worker=None):
+    """Списание прошло: следующий период, ошибки сброшены"""
+    owned, owner = _owned(worker)
+    _write(f'''
+        UPDATE subscriptions
+        SET state = 'active', last_payment = ?, last_error_message = NULL,
+            last_error = NULL, failures = 0, charge_id = NULL,
+            next_due_at = strftime('%Y-%m-%dT%H:%M:%f', ?, '+' || interval || ' seconds'),
+            retry_after = NULL, claimed_by = NULL, lease_expires = NULL
+        WHERE payment_method_id = ? AND state IN ({_entering('active')}){owned}
+    ''', (time, time, payment_id, *owner), ('subscriptions', payment_id))
+
+@timed
+def update_subscription_error(time, payment_id, retry_at, error=None, max_failures=0,
+                              worker=None):
+        """Списание не прошло: повтор в retry_at или, после max_failures
+        неудач подряд (0 - без ограничения), остановка подписки"""
+        owned, owner = _owned(worker)
+        _write(f'''
             UPDATE subscriptions
-            SET last_payment = ?, last_error_message = NULL
-            WHERE payment_method_id = ?
-        ''', (time, payment_id))
-        conn.commit()
-def update_subscription_error(time, payment_id):
-        with closing(sqlite3.connect(DATABASE_NAME)) as conn:
-            conn.execute('''
-                UPDATE subscriptions
-                SET last_error_message = ?
-                WHERE payment_method_id = ?
-            ''', (time, payment_id))
-            conn.commit()
+            SET state = CASE WHEN ? > 0 AND failures + 1 >= ?
+                             THEN 'suspended' ELSE 'retry_scheduled' END,
+                last_error_message = ?, last_error = ?, failures = failures + 1,
+                charge_id = NULL, next_due_at = ?, retry_after = NULL,
+                claimed_by = NULL, lease_expires = NULL
+            WHERE payment_method_id = ? AND state IN ({_entering('retry_scheduled')}){owned}
+        ''', (max_failures, max_failures, time, error, retry_at, payment_id, *owner),
+               ('subscriptions', payment_id))
 
+@timed
+def await_subscription_webhook(payment_id, check_at, charge_id, worker=None):
+    """Шлюз принял платёж charge_id без окончательного статуса: ждём вебхук
+    до check_at, затем планировщик спросит статус этого платежа"""
+    owned, owner = _owned(worker)
+    _write(f'''
+        UPDATE subscriptions
+        SET state = 'awaiting_webhook', next_due_at = ?, charge_id = ?,
+            retry_after = NULL, claimed_by = NULL, lease_expires = NULL
+        WHERE payment_method_id = ? AND state IN ({_entering('awaiting_webhook')}){owned}
+    ''', (check_at, charge_id, payment_id, *owner), ('subscriptions', payment_id))
 
+@timed
+def reschedule_subscription(payment_id, retry_after, worker=None):
+    """Возвращает взятое списание в очередь не раньше retry_after, не меняя
+    next_due_at, last_payment, last_error_message и charge_id: отложенная
+    подписка сохраняет свой срок и место в очереди самых просроченных.
+    Состояние возвращается то, из которого подписку взяли: charge_id есть
+    только у awaiting_webhook, last_error_message - только у retry_scheduled"""
+    owned, owner = _owned(worker)
+    _write(f'''
+        UPDATE subscriptions
+        SET state = CASE WHEN charge_id IS NOT NULL THEN 'awaiting_webhook'
+                         WHEN last_error_message IS NOT NULL THEN 'retry_scheduled'
+                         ELSE 'active' END,
+            retry_after = ?, claimed_by = NULL, lease_expires = NULL
+        WHERE payment_method_id = ? AND state = 'charging'{owned}
+    ''', (retry_after, payment_id, *owner), ('subscriptions', payment_id))
+
+
+@timed
 def update_set_refund_status(id):
-    with closing(sqlite3.connect(DATABASE_NAME)) as conn:
-        conn.execute(f'''
-        UPDATE payments
-        SET status = 'refunded'
-        WHERE id = '{id}'
-        ''')
-        conn.commit()
+    _write('''
+    UPDATE payments
+    SET status = 'refunded', refund_status = 'succeeded'
+    WHERE id = ?
+    ''', (id,), ('payments', id))
 
+@timed
+def update_refund_requested(id, refund_id, refund_status, requested_at):
+    """Возврат создан в шлюзе; пока он pending, его подтвердит вебхук или сверка"""
+    _write('''
+    UPDATE payments
+    SET refund_id = ?, refund_status = ?, refund_requested_at = ?,
+        status = CASE WHEN ? = 'succeeded' THEN 'refunded' ELSE status END
+    WHERE id = ?
+    ''', (refund_id, refund_status, requested_at, refund_status, id), ('payments', id))
+
+@timed
 def update_table(table, search_name, search_id, set_pairs):
     set_string = ", ".join([f"{l} = {r}" for (l, r) in set_pairs])
-    with closing(sqlite3.connect(DATABASE_NAME)) as conn:
+    with get_connection() as conn:
         conn.execute(f'''
         UPDATE {table}
         SET {set_string}
-        WHERE {search_name} =
+        WHERE {search_name} = ?
         ''', (search_id,))
-        conn.commit()
 
 
+@timed
 def payments_insert(id, chat_id, price, currency, status,
                     product, payment_method_id, is_recurrent, created_at):
-    with closing(sqlite3.connect(DATABASE_NAME)) as conn:
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            INSERT OR REPLACE INTO payments
-            (id, chat_id, amount, currency, status, description,
-                payment_method_id, is_recurrent, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (id, chat_id, price, currency, status,
-              product, payment_method_id, is_recurrent, created_at
-        ))
-        conn.commit()
+    _write('''
+        INSERT OR REPLACE INTO payments
+        (id, chat_id, amount, currency, status, description,
+            payment_method_id, is_recurrent, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (id, chat_id, price, currency, status,
+          product, payment_method_id, is_recurrent, created_at
+    ), ('payments', id))
 
+@timed
 def subscriptions_insert(payment_method_id, chat_id, saved, last_payment,
                          last_error_message, started, interval, amount,
                          currency, description):
-    with closing(sqlite3.connect(DATABASE_NAME)) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT OR REPLACE INTO subscriptions
-            (payment_method_id, chat_id, saved, last_payment,
-            last_error_message, started, interval, amount,
-            currency, description)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            (payment_method_id, chat_id, saved, last_payment,
-             last_error_message, started, interval, amount,
-             currency, description)
-        ))
-        conn.commit()
+    next_due_at = (datetime.fromisoformat(last_payment) +
+                   timedelta(seconds=int(interval))).isoformat()
+    state = 'active' if saved else 'suspended'
+    _write('''
+        INSERT OR REPLACE INTO subscriptions
+        (payment_method_id, chat_id, saved, last_payment,
+        last_error_message, started, interval, amount,
+        currency, description, next_due_at, state)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        (payment_method_id, chat_id, saved, last_payment,
+         last_error_message, started, interval, amount,
+         currency, description, next_due_at, state)
+    ), ('subscriptions', payment_method_id))
 
 
+@timed
 def get_orders(search_name, search_id, table='payments', num='all', select='*'):
-    with closing(sqlite3.connect(DATABASE_NAME)) as conn:
-        conn.row_factory = dict_factory
+    cursor = get_connection().cursor()
+    cursor.row_factory = dict_factory
+    # значение передаётся параметром, чтобы кэш подготовленных запросов sqlite3
+    # переиспользовал один и тот же statement для разных search_id
+    orders = cursor.execute(
+        f"select {select} from {table} where {search_name} = ?", (str(search_id),))
+    if num == 'all':
+        orders = orders.fetchall()
+    else:
+        orders = orders.fetchone()
+    cursor.close()
+    return orders
 
-        cursor = conn.cursor()
+def get_payment(id, cached=True):
+    """Платёж по id или None. Записи других процессов сбрасывают кэш этого
+    только через TTL, поэтому проверки перед движением денег читают
+    с cached=False"""
+    load = lambda: get_orders(search_name='id', search_id=id, num='one')
+    return row_cache.get_or_load(('payments', id), load) if cached else load()
 
-        orders = cursor.execute(
-            f"select {select} from {table} where {search_name} = \"{search_id}\"")
-        if num == 'all':
-            orders = orders.fetchall()
-        else:
-            orders = orders.fetchone()
+def get_subscription(payment_method_id, cached=True):
+    """Подписка по сохранённому способу оплаты или None (cached - как у get_payment)"""
+    load = lambda: get_orders(search_name='payment_method_id', search_id=payment_method_id,
+                              table='subscriptions', num='one')
+    return (row_cache.get_or_load(('subscriptions', payment_method_id), load)
+            if cached else load())
+
+@timed
+def get_orders_page(chat_id, status=None, limit=50, before=None):
+    """Заказы чата от новых к старым.
+    before - (created_at, id) последнего заказа предыдущей страницы"""
+    query = 'SELECT * FROM payments WHERE chat_id = ?'
+    params = [str(chat_id)]
+    if status is not None:
+        query += ' AND status = ?'
+        params.append(status)
+    if before is not None:
+        query += ' AND (created_at, id) < (?, ?)'
+        params.extend(before)
+    query += ' ORDER BY created_at DESC, id DESC LIMIT ?'
+    params.append(limit)
+    cursor = get_connection().cursor()
+    cursor.row_factory = dict_factory
+    orders = cursor.execute(query, params).fetchall()
+    cursor.close()
     return orders
 
-def get_active_subscriptions():
-    with closing(sqlite3.connect(DATABASE_NAME)) as conn:
-        conn.row_factory = sqlite3.Row
+@timed
+def claim_due_subscriptions(worker, now, lease_expires, limit, retries=False):
+    """Переводит в charging и берёт в аренду до limit подписок, срок которых
+    наступил, начиная с самых просроченных: первые попытки (вместе с
+    перепроверкой потерянных вебхуков и списаниями упавших реплик) или,
+    при retries, повторы после ошибки. Подписки, отложенные
+    reschedule_subscription, ждут своего retry_after.
+
+    Подписка в charging видна другим репликам только после lease_expires:
+    так упавший планировщик не держит её дольше аренды. Аренду снимают
+    update_subscription_success, update_subscription_error,
+    await_subscription_webhook и reschedule_subscription."""
+    # по ветке на состояние: каждая идёт по индексу (state, next_due_at) уже
+    # в порядке срока, и сортировать остаётся не больше limit строк на ветку
+    branch = '''SELECT * FROM (
+        SELECT payment_method_id, next_due_at FROM subscriptions
+        WHERE state = ? AND {} ORDER BY next_due_at LIMIT ?)'''
+    due = 'next_due_at <= ? AND (retry_after IS NULL OR retry_after <= ?)'
+    branches, params = [], []
+    for state in (('retry_scheduled',) if retries else ('active', 'awaiting_webhook')):
+        branches.append(branch.format(due))
+        params += [state, now, now, limit]
+    if not retries:
+        branches.append(branch.format('lease_expires <= ?'))
+        params += ['charging', now, limit]
+    with get_connection() as conn:
         cursor = conn.cursor()
+        cursor.row_factory = dict_factory
+        claimed = cursor.execute(f'''
+            UPDATE subscriptions
+            SET state = 'charging', claimed_by = ?, lease_expires = ?, retry_after = NULL
+            WHERE payment_method_id IN (
+                SELECT payment_method_id FROM ({' UNION ALL '.join(branches)})
+                ORDER BY next_due_at LIMIT ?)
+            RETURNING *
+        ''', (worker, lease_expires, *params, limit)).fetchall()
+        cursor.close()
+    for subscription in claimed:
+        row_cache.invalidate(('subscriptions', subscription['payment_method_id']))
+    return claimed
+
+@timed
+def get_next_due_at():
+    """Ближайший срок списания или None, если подписок нет.
+    Отложенная подписка уже просрочена, для неё это retry_after"""
+    branch = '''SELECT * FROM (
+        SELECT next_due_at AS due FROM subscriptions
+        WHERE state = '{}' AND retry_after IS NULL ORDER BY next_due_at LIMIT 1)'''
+    branches = [branch.format(state) for state in SUBSCRIPTION_DUE_STATES]
+    branches.append('SELECT MIN(retry_after) FROM subscriptions WHERE retry_after IS NOT NULL')
+    return get_connection().execute(
+        f"SELECT MIN(due) FROM ({' UNION ALL '.join(branches)})").fetchone()[0]
+
+
+@timed
+def queue_depths():
+    """Сколько событий ждут обработки в inbox и outbox"""
+    conn = get_connection()
+    return {
+        'webhook_inbox': conn.execute('''
+            SELECT COUNT(*) FROM webhook_inbox WHERE status IN ('new', 'processing')
+        ''').fetchone()[0],
+        'notification_outbox': conn.execute('''
+            SELECT COUNT(*) FROM notification_outbox WHERE status IN ('new', 'sending')
+        ''').fetchone()[0],
+    }
 
-        # Получаем все активные подписки
-        cursor.execute('''
-            SELECT * FROM subscriptions
-            WHERE saved = true AND last_error_message IS NULL
-        ''')
-        subscriptions = cursor.fetchall()
-    return subscriptions
-
-def get_failed_subscriptions():
-    with closing(sqlite3.connect(DATABASE_NAME)) as conn:
-        conn.row_factory = sqlite3.Row
+@timed
+def count_due_subscriptions(now):
+    return get_connection().execute(f'''
+        SELECT COUNT(*) FROM subscriptions
+        WHERE state IN ({_states(SUBSCRIPTION_DUE_STATES)}) AND next_due_at <= ?
+    ''', (now,)).fetchone()[0]
+
+@timed
+def get_backlog(now):
+    """Просроченные списания: число первых попыток и повторов, самый старый срок"""
+    backlog = {'first': 0, 'retry': 0, 'oldest': None}
+    for state, count, oldest in get_connection().execute(f'''
+        SELECT state, COUNT(*), MIN(next_due_at)
+        FROM subscriptions
+        WHERE state IN ({_states(SUBSCRIPTION_DUE_STATES)}) AND next_due_at <= ?
+        GROUP BY state
+    ''', (now,)):
+        backlog['retry' if state == 'retry_scheduled' else 'first'] += count
+        if backlog['oldest'] is None or oldest < backlog['oldest']:
+            backlog['oldest'] = oldest
+    return backlog
+
+
+# Входящие вебхуки (inbox): событие сохраняется до обработки,
+# обработчик забирает его с арендой (locked_until) и повторяет при сбое.
+def webhook_event_key(event, obj):
+    """Ключ события для дедупликации в inbox: (событие, id объекта, статус)"""
+    return f"{event}:{obj.get('id')}:{obj.get('status')}"
+
+
+# статусы, о которых YooKassa шлёт вебхук
+PAYMENT_EVENTS = {"succeeded": "payment.succeeded",
+                  "canceled": "payment.canceled",
+                  "waiting_for_capture": "payment.waiting_for_capture"}
+REFUND_EVENTS = {"succeeded": "refund.succeeded"}
+
+
+def webhook_event(events, obj):
+    """(event_key, event, payload) вебхука об объекте шлюза obj или None,
+    если вебхука не было бы. Такое событие в inbox notify-bot обработает как
+    настоящий вебхук, а настоящий, если всё же придёт, отбросит как повтор."""
+    event = events.get(obj["status"])
+    if event is None:
+        return None
+    payload = json.dumps({"type": "notification", "event": event, "object": obj},
+                         default=str)
+    return webhook_event_key(event, obj), event, payload
+
+@timed
+def inbox_replay(events, received_at):
+    """Добавляет в inbox события вебхуков, которые могли потеряться"""
+    with get_connection() as conn:
+        conn.executemany('''
+            INSERT OR IGNORE INTO webhook_inbox
+            (event_key, event, payload, status, attempts, received_at)
+            VALUES (?, ?, ?, 'new', 0, ?)
+        ''', [(*event, received_at) for event in events])
+
+@timed
+def inbox_insert(event_key, event, payload, received_at):
+    """Возвращает False, если событие с таким ключом уже было получено"""
+    with get_connection() as conn:
+        cursor = conn.execute('''
+            INSERT OR IGNORE INTO webhook_inbox
+            (event_key, event, payload, status, attempts, received_at)
+            VALUES (?, ?, ?, 'new', 0, ?)
+        ''', (event_key, event, payload, received_at))
+        return cursor.rowcount == 1
+
+@timed
+def inbox_claim(now, locked_until):
+    """Забирает самое старое готовое к обработке событие или возвращает None"""
+    with get_connection() as conn:
         cursor = conn.cursor()
+        cursor.row_factory = dict_factory
+        event = cursor.execute('''
+            UPDATE webhook_inbox
+            SET status = 'processing', attempts = attempts + 1, locked_until = ?
+            WHERE id = (
+                SELECT id FROM webhook_inbox
+                WHERE status IN ('new', 'processing')
+                    AND (locked_until IS NULL OR locked_until <= ?)
+                ORDER BY id LIMIT 1)
+            RETURNING *
+        ''', (locked_until, now)).fetchone()
+        cursor.close()
+    return event
+
+@timed
+def inbox_done(id, processed_at):
+    _write('''
+        UPDATE webhook_inbox
+        SET status = 'done', processed_at = ?, locked_until = NULL
+        WHERE id = ?
+    ''', (processed_at, id))
+
+@timed
+def inbox_purge(processed_before):
+    """Удаляет обработанные события старше срока, в течение которого возможны повторы"""
+    with get_connection() as conn:
+        return conn.execute('''
+            DELETE FROM webhook_inbox
+            WHERE status IN ('done', 'failed') AND received_at < ?
+        ''', (processed_before,)).rowcount
+
+@timed
+def inbox_retry(id, error, retry_at, max_attempts):
+    """Откладывает событие до retry_at; после max_attempts попыток - failed"""
+    with get_connection() as conn:
+        conn.execute('''
+            UPDATE webhook_inbox
+            SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'new' END,
+                last_error = ?, locked_until = ?
+            WHERE id = ?
+        ''', (max_attempts, error, retry_at, id))
+
+
+# Исходящие уведомления (outbox) для Telegram, та же схема аренды, что и у inbox.
+@timed
+def outbox_insert(chat_id, text, parse_mode, created_at):
+    _write('''
+        INSERT INTO notification_outbox
+        (chat_id, text, parse_mode, status, attempts, created_at)
+        VALUES (?, ?, ?, 'new', 0, ?)
+    ''', (str(chat_id), text, parse_mode, created_at))
+
+@timed
+def outbox_claim(now, locked_until, limit):
+    """Забирает до limit готовых к отправке уведомлений"""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = dict_factory
+        notifications = cursor.execute('''
+            UPDATE notification_outbox
+            SET status = 'sending', locked_until = ?
+            WHERE id IN (
+                SELECT id FROM notification_outbox
+                WHERE status IN ('new', 'sending')
+                    AND (locked_until IS NULL OR locked_until <= ?)
+                ORDER BY id LIMIT ?)
+            RETURNING *
+        ''', (locked_until, now, limit)).fetchall()
+        cursor.close()
+    return sorted(notifications, key=lambda n: n['id'])
+
+@timed
+def outbox_done(ids, sent_at):
+    with get_connection() as conn:
+        conn.executemany('''
+            UPDATE notification_outbox
+            SET status = 'sent', sent_at = ?, locked_until = NULL
+            WHERE id = ?
+        ''', [(sent_at, id) for id in ids])
+
+@timed
+def outbox_postpone(ids, until):
+    """Откладывает отправку без учёта попытки (ограничение частоты)"""
+    with get_connection() as conn:
+        conn.executemany('''
+            UPDATE notification_outbox
+            SET status = 'new', locked_until = ?
+            WHERE id = ?
+        ''', [(until, id) for id in ids])
+
+@timed
+def outbox_retry(ids, error, retry_at, max_attempts):
+    with get_connection() as conn:
+        conn.executemany('''
+            UPDATE notification_outbox
+            SET attempts = attempts + 1,
+                status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'new' END,
+                last_error = ?, locked_until = ?
+            WHERE id = ?
+        ''', [(max_attempts, error, retry_at, id) for id in ids])
+
+
+# Сверка со шлюзом: платежи и возвраты, для которых не пришёл вебхук.
+# checked_before не даёт спрашивать шлюз о той же строке на каждом проходе.
+@timed
+def get_stale_payments(created_before, checked_before, limit):
+    cursor = get_connection().cursor()
+    cursor.row_factory = dict_factory
+    stale = cursor.execute('''
+        SELECT * FROM payments
+        WHERE status = 'pending' AND created_at <= ?
+            AND (checked_at IS NULL OR checked_at <= ?)
+        ORDER BY created_at LIMIT ?
+    ''', (created_before, checked_before, limit)).fetchall()
+    cursor.close()
+    return stale
+
+@timed
+def get_stale_refunds(requested_before, checked_before, limit):
+    cursor = get_connection().cursor()
+    cursor.row_factory = dict_factory
+    stale = cursor.execute('''
+        SELECT * FROM payments
+        WHERE refund_status = 'pending' AND refund_requested_at <= ?
+            AND (checked_at IS NULL OR checked_at <= ?)
+        ORDER BY refund_requested_at LIMIT ?
+    ''', (requested_before, checked_before, limit)).fetchall()
+    cursor.close()
+    return stale
+
+@timed
+def reconcile(payments, refunds, events, checked_at):
+    """Применяет результаты сверки одной транзакцией.
+
+    payments - [(id, status)], refunds - [(id платежа, статус возврата)];
+    строки, уже изменённые вебхуком, не трогаются. events - [(event_key,
+    event, payload)] для notify-bot: побочные действия (подписки,
+    уведомления) выполняются так же, как при настоящем вебхуке, а если он
+    всё же придёт, inbox отбросит его как повтор."""
+    with get_connection() as conn:
+        conn.executemany('''
+            UPDATE payments SET status = ?, checked_at = ?
+            WHERE id = ? AND status = 'pending'
+        ''', [(status, checked_at, id) for id, status in payments])
+        conn.executemany('''
+            UPDATE payments
+            SET refund_status = ?, checked_at = ?,
+                status = CASE WHEN ? = 'succeeded' THEN 'refunded' ELSE status END
+            WHERE id = ? AND refund_status = 'pending'
+        ''', [(status, checked_at, status, id) for id, status in refunds])
+        conn.executemany('''
+            INSERT OR IGNORE INTO webhook_inbox
+            (event_key, event, payload, status, attempts, received_at)
+            VALUES (?, ?, ?, 'new', 0, ?)
+        ''', [(*event, checked_at) for event in events])
+    for id, _ in payments + refunds:
+        row_cache.invalidate(('payments', id))
+
+
+# Выгрузка для бухгалтерии: таблица -> (колонка даты, колонка статуса)
+EXPORTS = {
+    'payments': ('created_at', 'status'),
+    'subscriptions': ('started', 'state'),
+}
+EXPORT_FORMATS = ('csv', 'jsonl')
+EXPORT_BATCH = int(os.environ.get("DATABASE_EXPORT_BATCH", 1000))
+
+
+def export(table, format='csv', since=None, until=None, status=None, chat_id=None):
+    """Строки таблицы в CSV или JSONL кусками по EXPORT_BATCH строк.
+
+    Курсор читается порциями fetchmany на отдельном соединении, поэтому
+    память не зависит от размера выгрузки, а все строки берутся из одного
+    снимка базы (WAL не мешает записи). Порядок - по индексу колонки даты,
+    без сортировки всей выборки. since (включительно) и until (нет) - datetime:
+    строка вроде '2099' сравнивалась бы с TIMESTAMP как число."""
+    if table not in EXPORTS:
+        raise ValueError(f"unknown table {table!r}, expected one of {sorted(EXPORTS)}")
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"unknown format {format!r}, expected one of {EXPORT_FORMATS}")
+    date_column, status_column = EXPORTS[table]
+    conditions, params = [], []
+    for condition, value in ((f'{date_column} >= ?', None if since is None else since.isoformat()),
+                             (f'{date_column} < ?', None if until is None else until.isoformat()),
+                             (f'{status_column} = ?', status),
+                             ('chat_id = ?', None if chat_id is None else str(chat_id))):
+        if value is not None:
+            conditions.append(condition)
+            params.append(value)
+    query = f'SELECT * FROM {table}'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += f' ORDER BY {date_column}'
+
+    # генератор может продолжаться в другом потоке (StreamingResponse),
+    # но соединение в каждый момент использует только он
+    conn = _connect(check_same_thread=False)
+    try:
+        conn.execute('PRAGMA query_only = ON')
+        # если сортировка всё же понадобится, пусть она идёт во временный файл, а не в память
+        conn.execute('PRAGMA temp_store = DEFAULT')
+        cursor = conn.execute(query, params)
+        columns = [column[0] for column in cursor.description]
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if format == 'csv':
+            writer.writerow(columns)
+        while rows := cursor.fetchmany(EXPORT_BATCH):
+            if format == 'csv':
+                writer.writerows(rows)
+            else:
+                for row in rows:
+                    buffer.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+                    buffer.write('\n')
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if format == 'csv' and buffer.tell():
+            yield buffer.getvalue()
+    finally:
+        conn.close()
+
+
+# Миграции схемы: номер версии хранится в PRAGMA user_version,
+# каждая миграция применяется один раз в своей транзакции.
+MIGRATIONS = [
+    # 1: исходная схема
+    '''CREATE TABLE IF NOT EXISTS payments
+                    (id TEXT PRIMARY KEY,
+                    chat_id TEXT,
+                    amount REAL,
+                    currency TEXT,
+                    status TEXT,
+                    description TEXT,
+                    payment_method_id TEXT,
+                    is_recurrent BOOLEAN,
+                    refunded BOOLEAN DEFAULT FALSE,
+                    created_at TIMESTAMP
+                    );
+
+    CREATE TABLE IF NOT EXISTS subscriptions
+                    (payment_method_id TEXT PRIMARY KEY,
+                    chat_id TEXT,
+                    saved BOOLEAN,
+                    last_payment TIMESTAMP,
+                    last_error_message TIMESTAMP,
+                    started TIMESTAMP,
+                    interval INT,
+                    amount REAL,
+                    currency TEXT,
+                    description TEXT
+                    );''',
+    # interval should be month maybe
+
+    # 2: заказы чата (get_orders_page) - по индексу в порядке (created_at, id)
+    '''CREATE INDEX IF NOT EXISTS payments_chat_page
+        ON payments (chat_id, created_at, id);''',
+
+    # 3: хранимый срок следующего списания, чтобы планировщик не сканировал все подписки.
+    # У подписок с ошибкой срок пересчитается при следующей попытке.
+    '''ALTER TABLE subscriptions ADD COLUMN next_due_at TIMESTAMP;
+    UPDATE subscriptions SET next_due_at =
+        strftime('%Y-%m-%dT%H:%M:%f', last_payment, '+' || interval || ' seconds');''',
+
+    # 4: durable inbox для вебхуков notify-bot. inbox_claim берёт самое старое
+    # ожидающее событие по частичному индексу в порядке id, не сортируя все
+    # ожидающие события.
+    '''CREATE TABLE IF NOT EXISTS webhook_inbox
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    event_key TEXT UNIQUE,
+                    event TEXT,
+                    payload TEXT,
+                    status TEXT,
+                    attempts INT,
+                    locked_until TIMESTAMP,
+                    last_error TEXT,
+                    received_at TIMESTAMP,
+                    processed_at TIMESTAMP
+                    );
+    CREATE INDEX IF NOT EXISTS webhook_inbox_pending_id
+        ON webhook_inbox (id) WHERE status IN ('new', 'processing');''',
+
+    # 5: outbox уведомлений notify-bot, тот же частичный индекс для
+    # outbox_claim (ожидающие уведомления - new и sending)
+    '''CREATE TABLE IF NOT EXISTS notification_outbox
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id TEXT,
+                    text TEXT,
+                    parse_mode TEXT,
+                    status TEXT,
+                    attempts INT,
+                    locked_until TIMESTAMP,
+                    last_error TEXT,
+                    created_at TIMESTAMP,
+                    sent_at TIMESTAMP
+                    );
+    CREATE INDEX IF NOT EXISTS notification_outbox_pending_id
+        ON notification_outbox (id) WHERE status IN ('new', 'sending');''',
+
+    # 6: постраничная выдача заказов с фильтром по статусу (keyset по created_at, id)
+    '''CREATE INDEX IF NOT EXISTS payments_chat_status_page
+        ON payments (chat_id, status, created_at, id);''',
+
+    # 7: аренда подписок репликами планировщика (claim_due_subscriptions)
+    '''ALTER TABLE subscriptions ADD COLUMN claimed_by TEXT;
+    ALTER TABLE subscriptions ADD COLUMN lease_expires TIMESTAMP;''',
+
+    # 8: явное состояние подписки (SUBSCRIPTION_TRANSITIONS) вместо saved и
+    # last_error_message; очереди планировщика - по индексу (state, next_due_at)
+    '''ALTER TABLE subscriptions ADD COLUMN state TEXT NOT NULL DEFAULT 'active';
+    ALTER TABLE subscriptions ADD COLUMN failures INT NOT NULL DEFAULT 0;
+    ALTER TABLE subscriptions ADD COLUMN last_error TEXT;
+    UPDATE subscriptions SET state = CASE
+        WHEN NOT saved THEN 'suspended'
+        WHEN last_error_message IS NOT NULL THEN 'retry_scheduled'
+        ELSE 'active' END,
+        failures = last_error_message IS NOT NULL;
+    CREATE INDEX IF NOT EXISTS subscriptions_state_due
+        ON subscriptions (state, next_due_at);''',
+
+    # 9: сверка зависших платежей и возвратов со шлюзом (reconciler.py);
+    # частичные индексы содержат только ожидающие строки
+    '''ALTER TABLE payments ADD COLUMN refund_id TEXT;
+    ALTER TABLE payments ADD COLUMN refund_status TEXT;
+    ALTER TABLE payments ADD COLUMN refund_requested_at TIMESTAMP;
+    ALTER TABLE payments ADD COLUMN checked_at TIMESTAMP;
+    CREATE INDEX IF NOT EXISTS payments_pending
+        ON payments (created_at) WHERE status = 'pending';
+    CREATE INDEX IF NOT EXISTS payments_refund_pending
+        ON payments (refund_requested_at) WHERE refund_status = 'pending';''',
+
+    # 10: выгрузка по диапазону дат (export) идёт по индексу, без сортировки
+    '''CREATE INDEX IF NOT EXISTS payments_created_at ON payments (created_at);
+    CREATE INDEX IF NOT EXISTS subscriptions_started ON subscriptions (started);''',
+
+    # 11: платёж, по которому ждём вебхук: перепроверяется запросом статуса,
+    # а не повторным созданием (YooKassa хранит ключ идемпотентности сутки)
+    'ALTER TABLE subscriptions ADD COLUMN charge_id TEXT;',
+
+    # 12: выгрузка подписок в одном состоянии тоже идёт по индексу в порядке started
+    'CREATE INDEX IF NOT EXISTS subscriptions_state_started ON subscriptions (state, started);',
+
+    # 13: недоступный шлюз откладывает списание до retry_after, не трогая
+    # next_due_at: после восстановления очередь снова идёт от самых просроченных
+    '''ALTER TABLE subscriptions ADD COLUMN retry_after TIMESTAMP;
+    CREATE INDEX IF NOT EXISTS subscriptions_retry_after
+        ON subscriptions (retry_after) WHERE retry_after IS NOT NULL;''',
+]
+
+
+def migrate(conn=None):
+    """Применяет недостающие миграции к существующей базе"""
+    conn = conn or get_connection()
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, script in enumerate(MIGRATIONS[version:], start=version + 1):
+        # executescript сам делает COMMIT, поэтому транзакция открывается внутри скрипта
+        try:
+            conn.executescript(
+                f'BEGIN;\n{script}\nPRAGMA user_version = {number};\nCOMMIT;')
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+    return len(MIGRATIONS)
+
 
-        # Получаем все активные подписки
-        cursor.execute('''
-            SELECT * FROM subscriptions
-            WHERE last_error_message IS NOT NULL
-        ''')
-        failed_subs = cursor.fetchall()
-    return failed_subs
+def main():
+    parser = argparse.ArgumentParser(
+        description="Без аргументов применяет миграции к DATABASE_NAME.")
+    commands = parser.add_subparsers(dest='command')
+    export_parser = commands.add_parser('export', help='выгрузить таблицу в CSV или JSONL')
+    export_parser.add_argument('table', choices=sorted(EXPORTS))
+    export_parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+    export_parser.add_argument('--since', type=datetime.fromisoformat, help='с даты включительно (ISO 8601)')
+    export_parser.add_argument('--until', type=datetime.fromisoformat, help='до даты, не включая (ISO 8601)')
+    export_parser.add_argument('--status', help='статус платежа или состояние подписки')
+    export_parser.add_argument('--chat-id')
+    export_parser.add_argument('-o', '--output', help='файл; по умолчанию stdout')
+    args = parser.parse_args()
 
+    if args.command != 'export':
+        print("database schema version:", migrate())
+        return
+    output = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        for chunk in export(args.table, args.format, args.since, args.until,
+                            args.status, args.chat_id):
+            output.write(chunk)
+    finally:
+        if args.output:
+            output.close()
 
 
 if __name__ == '__main__':
-    with closing(sqlite3.connect(DATABASE_NAME)) as conn:
-        conn.execute('''CREATE TABLE IF NOT EXISTS payments
-                        (id TEXT PRIMARY KEY,
-                        chat_id TEXT,
-                        amount REAL,
-                        currency TEXT,
-                        status TEXT,
-                        description TEXT,
-                        payment_method_id TEXT,
-                        is_recurrent BOOLEAN,
-                        refunded BOOLEAN DEFAULT FALSE,
-                        created_at TIMESTAMP
-                        );''')
-
-        conn.execute('''CREATE TABLE IF NOT EXISTS subscriptions
-                        (payment_method_id TEXT PRIMARY KEY,
-                        chat_id TEXT,
-                        saved BOOLEAN,
-                        last_payment TIMESTAMP,
-                        last_error_message TIMESTAMP,
-                        started TIMESTAMP,
-                        interval INT,
-                        amount REAL,
-                        currency TEXT,
-                        description TEXT
-                        );''')
-        # interval should be month maybe
-        conn.commit()
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""Асинхронный фасад над bd.py для FastAPI обработчиков.
+
+Чтения выполняются в пуле потоков (у каждого потока своё соединение, WAL
+позволяет читать параллельно), записи - в одном выделенном потоке, который
+работает как очередь записи и не даёт писателям конкурировать за блокировку.
+"""
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+import bd
+
+DATABASE_READ_WORKERS = int(os.environ.get("DATABASE_READ_WORKERS", 4))
+
+_reader = ThreadPoolExecutor(max_workers=DATABASE_READ_WORKERS,
+                             thread_name_prefix="bd-read")
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bd-write")
+
+
+def _in_executor(executor, func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        # run_in_executor не переносит contextvars, а trace запроса живёт в них
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(
+            executor, functools.partial(context.run, func, *args, **kwargs))
+    return wrapper
+
+
+def reads(func):
+    return _in_executor(_reader, func)
+
+
+def writes(func):
+    return _in_executor(_writer, func)
+
+
+def batched_writes(func):
+    """При групповой записи (DATABASE_BATCH_WRITES) порядок задаёт bd.batch_writer:
+    запрос ставится в его очередь прямо из event loop, коммит ожидается без потока"""
+    if bd.batch_writer is None:
+        return writes(func)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with bd.deferred_writes() as futures:
+            result = func(*args, **kwargs)
+        if bd.DATABASE_BATCH_DURABLE:
+            await asyncio.gather(*map(asyncio.wrap_future, futures))
+        return result
+    return wrapper
+
+
+get_orders_page = reads(bd.get_orders_page)
+get_payment = reads(bd.get_payment)
+get_subscription = reads(bd.get_subscription)
+queue_depths = reads(bd.queue_depths)
+count_due_subscriptions = reads(bd.count_due_subscriptions)
+get_stale_payments = reads(bd.get_stale_payments)
+get_stale_refunds = reads(bd.get_stale_refunds)
+
+payments_insert = batched_writes(bd.payments_insert)
+subscriptions_insert = batched_writes(bd.subscriptions_insert)
+update_set_refund_status = batched_writes(bd.update_set_refund_status)
+update_refund_requested = batched_writes(bd.update_refund_requested)
+update_subscription_success = batched_writes(bd.update_subscription_success)
+update_subscription_error = batched_writes(bd.update_subscription_error)
+inbox_insert = writes(bd.inbox_insert)
+inbox_claim = writes(bd.inbox_claim)
+inbox_done = batched_writes(bd.inbox_done)
+inbox_retry = writes(bd.inbox_retry)
+inbox_purge = writes(bd.inbox_purge)
+outbox_insert = batched_writes(bd.outbox_insert)
+outbox_claim = writes(bd.outbox_claim)
+outbox_done = writes(bd.outbox_done)
+outbox_postpone = writes(bd.outbox_postpone)
+outbox_retry = writes(bd.outbox_retry)
+reconcile = writes(bd.reconcile)
+
+
+def shutdown():
+    _reader.shutdown(wait=False)
+    _writer.shutdown(wait=True)
+    if bd.batch_writer is not None:
+        bd.batch_writer.close()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""Записей в секунду: отдельный коммит на строку против групповой записи.
+
+Запуск: python benchmarks/bd_batch_writes.py [кол-во записей] [потоков] [synchronous]
+"""
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ["DATABASE_NAME"] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+if len(sys.argv) > 3:
+    os.environ["DATABASE_SYNCHRONOUS"] = sys.argv[3]
+import bd  # noqa: E402
+
+EVENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+THREADS = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+
+
+def insert(i, prefix):
+    bd.payments_insert(
+        id=f'{prefix}{i}', chat_id=str(i % 1000), price=100.0, currency='RUB',
+        status='succeeded', product='product:Product 1', payment_method_id=None,
+        is_recurrent=False, created_at='2024-01-01T00:00:00')
+
+
+def measure(label, prefix, threads):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(lambda i: insert(i, prefix), range(EVENTS)))
+    elapsed = time.perf_counter() - start
+    print(f"{label}: {EVENTS / elapsed:.0f} events/s")
+
+
+if __name__ == '__main__':
+    bd.migrate()
+    print(f"{EVENTS} payments, {THREADS} threads, synchronous={bd.DATABASE_SYNCHRONOUS}")
+    measure("per-row commit, 1 thread", 'a', 1)
+    measure(f"per-row commit, {THREADS} threads", 'b', THREADS)
+
+    bd.batch_writer = bd.BatchWriter(bd.DATABASE_BATCH_MAX_ROWS, bd.DATABASE_BATCH_MAX_DELAY)
+    measure(f"group commit (durable), {THREADS} threads", 'c', THREADS)
+    bd.DATABASE_BATCH_DURABLE = False
+    measure(f"group commit (no wait), {THREADS} threads", 'd', THREADS)
+    bd.batch_writer.close()
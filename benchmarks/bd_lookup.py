@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""Время выборки заказов чата на большой таблице payments до и после индексов.
+
+Запуск: python benchmarks/bd_lookup.py [кол-во платежей] [кол-во чатов]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ["DATABASE_NAME"] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+import bd  # noqa: E402
+
+PAYMENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+CHATS = int(sys.argv[2]) if len(sys.argv) > 2 else 10_000
+LOOKUPS = 200
+
+
+def fill(conn):
+    rows = ((f'p{i}', str(i % CHATS), 100.0, 'RUB', 'succeeded',
+             'product:Product 1', None, False, f'2024-01-01T00:00:{i:09d}')
+            for i in range(PAYMENTS))
+    with conn:
+        conn.executemany('''
+            INSERT INTO payments
+            (id, chat_id, amount, currency, status, description,
+                payment_method_id, is_recurrent, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+
+
+def measure(label):
+    chats = [random.randrange(CHATS) for _ in range(LOOKUPS)]
+    start = time.perf_counter()
+    for chat_id in chats:
+        bd.get_orders(search_name='chat_id', search_id=chat_id)
+    elapsed = (time.perf_counter() - start) / LOOKUPS
+    print(f"{label}: {elapsed * 1000:.3f} ms per get_orders(chat_id)")
+
+
+if __name__ == '__main__':
+    conn = bd.get_connection()
+    conn.executescript(bd.MIGRATIONS[0] + '\nPRAGMA user_version = 1;')
+    print(f"filling {PAYMENTS} payments for {CHATS} chats...")
+    fill(conn)
+    measure("without indexes")
+    bd.migrate()
+    measure("with indexes")
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Апдейты в секунду в telegram-bot.py при медленном сервере.
+
+Поднимает локальный сервер, отвечающий на /api/orders с задержкой, и прогоняет
+через show_orders заданное число апдейтов с ограничением одновременности,
+как Application с concurrent_updates:
+    python benchmarks/bot_updates.py --delay 0.5 --updates 200 --concurrency 64
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+
+def slow_server(delay):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            time.sleep(delay)
+            body = json.dumps({"orders": [{"time": "2024-01-01", "id": "p1",
+                                           "product": "Product 1", "status": "succeeded"}],
+                               "next_cursor": None}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class FakeChat:
+    async def send_message(self, *args, **kwargs):
+        pass
+
+    reply_text = send_message
+
+
+class FakeUpdate:
+    message = FakeChat()
+    effective_user = FakeChat()
+
+
+def load_bot(server_url, concurrency):
+    os.environ["SERVER_API_URL"] = server_url
+    os.environ["BOT_CONCURRENT_UPDATES"] = str(concurrency)
+    spec = importlib.util.spec_from_file_location(
+        "telegram_bot", os.path.join(ROOT, "telegram-bot.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+async def run(bot, updates, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def handle(chat_id):
+        async with semaphore:
+            await bot.show_orders(FakeUpdate(), chat_id)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(handle(i) for i in range(updates)))
+    elapsed = time.perf_counter() - start
+    await bot.http_client.aclose()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--delay', type=float, default=0.5,
+                        help='задержка ответа сервера, с')
+    parser.add_argument('--updates', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=64)
+    args = parser.parse_args()
+
+    server = slow_server(args.delay)
+    url = f"http://127.0.0.1:{server.server_address[1]}/api"
+    for concurrency in (1, args.concurrency):
+        bot = load_bot(url, concurrency)
+        updates = args.updates if concurrency > 1 else min(args.updates, 10)
+        elapsed = asyncio.run(run(bot, updates, concurrency))
+        print(f"concurrency {concurrency}: {updates} updates in {elapsed:.2f}s, "
+              f"{updates / elapsed:.1f} updates/s")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Локальная заглушка Telegram Bot API для нагрузочных тестов notify-bot.py.
+
+Отвечает на getMe и sendMessage с заданной задержкой, а при превышении
+--flood-rps сообщений в секунду возвращает 429 с retry_after, как Telegram:
+    python benchmarks/fake_telegram.py --port 5102 --latency 0.03
+
+notify-bot.py направляется на неё через TELEGRAM_API_URL=http://127.0.0.1:5102.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from urllib.parse import parse_qsl
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+settings = argparse.Namespace(latency=0.03, jitter=0.5, failure_rate=0.0, flood_rps=0.0)
+stats = {"messages": 0, "flood_waits": 0, "errors": 0}
+window = {"second": 0, "count": 0}
+
+app = FastAPI()
+
+
+async def parameters(request: Request) -> dict:
+    body = await request.body()
+    if request.headers.get("content-type", "").startswith("application/json"):
+        return json.loads(body or b"{}")
+    return dict(parse_qsl(body.decode()))
+
+
+def flooded() -> bool:
+    second = int(time.monotonic())
+    if window["second"] != second:
+        window.update(second=second, count=0)
+    window["count"] += 1
+    return bool(settings.flood_rps) and window["count"] > settings.flood_rps
+
+
+@app.post("/bot{token}/{method}")
+async def bot_api(token: str, method: str, request: Request):
+    params = await parameters(request)
+    if method == "getMe":
+        return {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "bench",
+                                       "username": "bench_bot"}}
+    if method != "sendMessage":
+        return {"ok": True, "result": True}
+
+    await asyncio.sleep(settings.latency * random.uniform(
+        1 - settings.jitter, 1 + settings.jitter))
+    if flooded():
+        stats["flood_waits"] += 1
+        return JSONResponse({"ok": False, "error_code": 429,
+                             "description": "Too Many Requests: retry after 1",
+                             "parameters": {"retry_after": 1}}, status_code=429)
+    if random.random() < settings.failure_rate:
+        stats["errors"] += 1
+        return JSONResponse({"ok": False, "error_code": 500,
+                             "description": "Internal Server Error"}, status_code=500)
+    stats["messages"] += 1
+    return {"ok": True, "result": {
+        "message_id": stats["messages"],
+        "date": int(time.time()),
+        "chat": {"id": int(chat_id) if (chat_id := str(params.get("chat_id", "0"))).lstrip("-").isdigit() else 0,
+                 "type": "private"},
+        "text": params.get("text", ""),
+    }}
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=5102)
+    parser.add_argument('--latency', type=float, default=settings.latency)
+    parser.add_argument('--jitter', type=float, default=settings.jitter)
+    parser.add_argument('--failure-rate', type=float, default=settings.failure_rate)
+    parser.add_argument('--flood-rps', type=float, default=settings.flood_rps,
+                        help='сообщений в секунду до ответа 429; 0 - без ограничения')
+    args = parser.parse_args()
+    vars(settings).update({k: v for k, v in vars(args).items() if k != 'port'})
+    uvicorn.run(app, host='127.0.0.1', port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
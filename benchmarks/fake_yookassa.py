@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""Локальная заглушка YooKassa API для нагрузочных тестов.
+
+Принимает POST /v3/payments и /v3/refunds так же, как настоящий шлюз
+(ключ идемпотентности, формат ответа), с заданной задержкой и долей
+временных ошибок, и затем шлёт вебхуки о результате в notify-bot:
+    python benchmarks/fake_yookassa.py --port 5101 --latency 0.05 \
+        --failure-rate 0.01 --webhook-url http://127.0.0.1:5002/webhook
+
+server.py направляется на неё через YOOKASSA_API_URL=http://127.0.0.1:5101/v3.
+"""
+import argparse
+import asyncio
+import random
+import uuid
+from datetime import datetime
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+settings = argparse.Namespace(latency=0.05, jitter=0.5, failure_rate=0.0,
+                              webhook_url=None, webhook_delay=0.1,
+                              duplicate_rate=0.0, auto_confirm=True)
+payments = {}
+refunds = {}
+responses = {}  # ключ идемпотентности -> ответ
+stats = {"payments": 0, "refunds": 0, "errors": 0, "webhooks": 0,
+         "webhook_errors": 0, "webhooks_pending": 0}
+client = None
+
+app = FastAPI()
+
+
+@app.on_event("startup")
+async def startup():
+    global client
+    client = httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=100))
+
+
+async def gateway_delay():
+    await asyncio.sleep(settings.latency * random.uniform(
+        1 - settings.jitter, 1 + settings.jitter))
+
+
+def emit(event: str, obj: dict):
+    if settings.webhook_url:
+        stats["webhooks_pending"] += 1
+        asyncio.get_running_loop().create_task(send_webhook(event, dict(obj)))
+
+
+async def send_webhook(event: str, obj: dict):
+    """Доставка как у YooKassa: повторы до ответа 200, иногда повторная доставка"""
+    try:
+        await asyncio.sleep(settings.webhook_delay)
+        body = {"type": "notification", "event": event, "object": obj}
+        copies = 2 if random.random() < settings.duplicate_rate else 1
+        for _ in range(copies):
+            for attempt in range(5):
+                try:
+                    response = await client.post(settings.webhook_url, json=body)
+                    if response.status_code == 200:
+                        stats["webhooks"] += 1
+                        break
+                except httpx.HTTPError:
+                    pass
+                stats["webhook_errors"] += 1
+                await asyncio.sleep(0.5 * 2 ** attempt)
+    finally:
+        stats["webhooks_pending"] -= 1
+
+
+def idempotent(operation: str):
+    def decorator(create):
+        async def handler(request: Request):
+            key = request.headers.get("Idempotence-Key")
+            if key in responses:
+                return JSONResponse(responses[key])
+            await gateway_delay()
+            if random.random() < settings.failure_rate:
+                stats["errors"] += 1
+                return JSONResponse({"type": "error", "code": "internal_server_error"},
+                                    status_code=random.choice((500, 503)))
+            result = create(await request.json())
+            stats[operation] += 1
+            if key:
+                responses[key] = result
+            return JSONResponse(result)
+        app.post(f"/v3/{operation}")(handler)
+        return create
+    return decorator
+
+
+@idempotent("payments")
+def create_payment(payload: dict) -> dict:
+    payment_method_id = payload.get("payment_method_id")
+    payment = {
+        "id": str(uuid.uuid4()),
+        # по сохранённому способу оплаты списание проходит сразу
+        "status": "succeeded" if payment_method_id else "pending",
+        "paid": bool(payment_method_id),
+        "amount": payload["amount"],
+        "description": payload.get("description"),
+        "merchant_customer_id": payload.get("merchant_customer_id"),
+        "metadata": payload.get("metadata", {}),
+        "payment_method": {
+            "type": "bank_card",
+            "id": payment_method_id or str(uuid.uuid4()),
+            "saved": bool(payment_method_id or payload.get("save_payment_method")),
+        },
+        "created_at": datetime.utcnow().isoformat() + "Z",
+        "test": True,
+        "refundable": bool(payment_method_id),
+    }
+    if not payment_method_id:
+        payment["confirmation"] = {
+            "type": "redirect",
+            "confirmation_url": f"https://yoomoney.ru/checkout/payments/v2/contract?orderId={payment['id']}",
+        }
+    payments[payment["id"]] = payment
+    if payment["status"] == "succeeded":
+        emit("payment.succeeded", payment)
+    elif settings.auto_confirm:
+        # покупатель сразу оплачивает по ссылке
+        payment["status"] = "succeeded"
+        payment["paid"] = True
+        emit("payment.succeeded", payment)
+        payment = {**payment, "status": "pending", "paid": False}
+    return payment
+
+
+@idempotent("refunds")
+def create_refund(payload: dict) -> dict:
+    refund = {
+        "id": str(uuid.uuid4()),
+        "payment_id": payload["payment_id"],
+        "status": "succeeded",
+        "amount": payload["amount"],
+        "created_at": datetime.utcnow().isoformat() + "Z",
+    }
+    refunds[refund["id"]] = refund
+    emit("refund.succeeded", refund)
+    return refund
+
+
+@app.get("/v3/payments/{payment_id}")
+async def get_payment(payment_id: str):
+    await gateway_delay()
+    if payment_id not in payments:
+        return JSONResponse({"type": "error", "code": "not_found"}, status_code=404)
+    return payments[payment_id]
+
+
+@app.get("/v3/refunds/{refund_id}")
+async def get_refund(refund_id: str):
+    await gateway_delay()
+    if refund_id not in refunds:
+        return JSONResponse({"type": "error", "code": "not_found"}, status_code=404)
+    return refunds[refund_id]
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=5101)
+    parser.add_argument('--latency', type=float, default=settings.latency,
+                        help='средняя задержка ответа, с')
+    parser.add_argument('--jitter', type=float, default=settings.jitter,
+                        help='разброс задержки, доля от средней')
+    parser.add_argument('--failure-rate', type=float, default=settings.failure_rate,
+                        help='доля ответов 500/503')
+    parser.add_argument('--webhook-url', default=settings.webhook_url)
+    parser.add_argument('--webhook-delay', type=float, default=settings.webhook_delay)
+    parser.add_argument('--duplicate-rate', type=float, default=settings.duplicate_rate,
+                        help='доля вебхуков, доставляемых дважды')
+    parser.add_argument('--no-auto-confirm', dest='auto_confirm', action='store_false',
+                        help='не подтверждать платежи по ссылке автоматически')
+    args = parser.parse_args()
+    vars(settings).update({k: v for k, v in vars(args).items() if k != 'port'})
+    uvicorn.run(app, host='127.0.0.1', port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
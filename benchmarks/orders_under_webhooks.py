@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""Задержка GET /api/orders в покое и во время потока вебхуков в notify-bot.
+
+Нужны запущенные server.py и notify-bot.py (см. start.sh):
+    python benchmarks/orders_under_webhooks.py --server http://127.0.0.1:5001 \
+        --notify http://127.0.0.1:5002 --duration 10 --webhooks 50
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+import httpx
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else float('nan')
+
+
+def report(label, latencies):
+    print(f"{label}: {len(latencies)} requests, "
+          f"p50 {percentile(latencies, 0.5) * 1000:.1f} ms, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.1f} ms, "
+          f"mean {statistics.fmean(latencies) * 1000:.1f} ms")
+
+
+async def poll_orders(client, url, chat_id, deadline, latencies):
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        await client.get(f"{url}/api/orders", params={"chat_id": chat_id})
+        latencies.append(time.perf_counter() - start)
+
+
+async def send_webhooks(client, url, chat_id, deadline):
+    while time.monotonic() < deadline:
+        await client.post(f"{url}/webhook", json={
+            "type": "notification",
+            "event": "payment.succeeded",
+            "object": {
+                "id": str(uuid.uuid4()),
+                "status": "succeeded",
+                "amount": {"value": "100.00", "currency": "RUB"},
+                "description": "product:Product 1",
+                "merchant_customer_id": chat_id,
+                "payment_method": {"id": str(uuid.uuid4()), "saved": False},
+            },
+        })
+
+
+async def run(args, webhooks):
+    latencies = []
+    deadline = time.monotonic() + args.duration
+    async with httpx.AsyncClient(timeout=30) as client:
+        await asyncio.gather(
+            *(poll_orders(client, args.server, args.chat_id, deadline, latencies)
+              for _ in range(args.readers)),
+            *(send_webhooks(client, args.notify, args.chat_id, deadline)
+              for _ in range(webhooks)))
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--server', default='http://127.0.0.1:5001')
+    parser.add_argument('--notify', default='http://127.0.0.1:5002')
+    parser.add_argument('--chat-id', default='1')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--readers', type=int, default=10)
+    parser.add_argument('--webhooks', type=int, default=50,
+                        help='одновременных отправителей вебхуков')
+    args = parser.parse_args()
+
+    report("idle", asyncio.run(run(args, 0)))
+    report("during webhooks", asyncio.run(run(args, args.webhooks)))
+
+
+if __name__ == '__main__':
+    main()
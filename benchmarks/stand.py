@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+"""Сквозной нагрузочный тест server.py и notify-bot.py с заглушками шлюза и Telegram.
+
+Поднимает fake_yookassa.py, fake_telegram.py, server.py, notify-bot.py и
+--schedulers реплик scheduler.py на временной базе, прогоняет сценарии и печатает пропускную способность и p50/p99:
+  orders   - POST /api/create_order, затем обработка вебхуков об оплате
+  webhooks - шторм вебхуков (с повторными доставками) в notify-bot
+  refunds  - POST /api/refund по оплаченным платежам и вебхуки refund.succeeded
+  billing  - цикл рекуррентных списаний по --subscriptions подпискам
+Задержки на стороне клиента меряются здесь, задержки обработки - по разнице
+гистограмм /metrics сервисов до и после сценария:
+    python benchmarks/stand.py --scenarios orders,webhooks,refunds,billing \
+        --gateway-latency 0.05 --gateway-failure-rate 0.01 --subscriptions 100000
+"""
+import argparse
+import asyncio
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+import httpx
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+SAMPLE = re.compile(r'^(\w+)(?:\{(.*)\})? (\S+)$')
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else float('nan')
+
+
+def report(label, count, elapsed, p50, p99):
+    print(f"{label}: {count} in {elapsed:.1f} s, {count / elapsed:.1f}/s, "
+          f"p50 {p50 * 1000:.1f} ms, p99 {p99 * 1000:.1f} ms")
+
+
+async def scrape(client, url) -> dict:
+    """Сэмплы /metrics: (имя, метки без le) -> {le или None: значение}"""
+    samples = {}
+    for line in (await client.get(f"{url}/metrics")).text.splitlines():
+        if match := SAMPLE.match(line):
+            name, labels, value = match.groups()
+            labels = dict(re.findall(r'(\w+)="([^"]*)"', labels or ''))
+            le = labels.pop('le', None)
+            key = (name, tuple(sorted(labels.items())))
+            samples.setdefault(key, {})[le] = float(value)
+    return samples
+
+
+async def scrape_all(client, urls) -> dict:
+    """Сэмплы нескольких реплик одного сервиса, сложенные вместе"""
+    total = {}
+    for samples in await asyncio.gather(*(scrape(client, url) for url in urls)):
+        for key, values in samples.items():
+            merged = total.setdefault(key, {})
+            for le, value in values.items():
+                merged[le] = merged.get(le, 0) + value
+    return total
+
+
+def gauge(samples, name, **labels) -> float:
+    return samples.get((name, tuple(sorted(labels.items()))), {}).get(None, 0.0)
+
+
+def buckets(samples, name) -> dict:
+    """Накопленные счётчики гистограммы по границам, сумма по всем меткам"""
+    total = {}
+    for (sample, _), values in samples.items():
+        if sample == f"{name}_bucket":
+            for le, value in values.items():
+                total[le] = total.get(le, 0) + value
+    return total
+
+
+def histogram_quantile(before, after, name, q) -> float:
+    """Квантиль наблюдений между двумя снимками, как histogram_quantile в Prometheus"""
+    start, end = buckets(before, name), buckets(after, name)
+    delta = sorted(((float(le), end[le] - start.get(le, 0)) for le in end),
+                   key=lambda bucket: bucket[0])
+    if not delta or delta[-1][1] == 0:
+        return float('nan')
+    rank = q * delta[-1][1]
+    lower, below = 0.0, 0
+    for bound, count in delta:
+        if count >= rank:
+            if math.isinf(bound):
+                return lower
+            return lower + (bound - lower) * (rank - below) / max(count - below, 1)
+        lower, below = bound, count
+    return lower
+
+
+class Stand:
+    def __init__(self, args):
+        self.args = args
+        self.dir = tempfile.mkdtemp(prefix='stand-')
+        self.processes = []
+        port = args.base_port
+        self.gateway, self.telegram, self.server, self.notify = (
+            f"http://127.0.0.1:{port + i}" for i in range(4))
+        self.schedulers = [f"http://127.0.0.1:{port + 4 + i}" for i in range(args.schedulers)]
+        self.env = {
+            **os.environ,
+            "DATABASE_NAME": os.path.join(self.dir, 'bench.db'),
+            "API_KEY": "bench", "SHOP_ID": "bench", "URL": "http://127.0.0.1",
+            "YOOKASSA_API_URL": f"{self.gateway}/v3",
+            "TELEGRAM_BOT_TOKEN": "1:bench",
+            "TELEGRAM_API_URL": self.telegram,
+            "TELEGRAM_GLOBAL_RPS": str(args.telegram_rps),
+            "RECURRENT_PAYMENT_CHECK_INTERVAL": "1",
+            "RECURRENT_PAYMENT_RETRY_FAILED_PAYMENT_INTERVAL": "3600",
+            "RECURRENT_PAYMENT_WORKERS": str(args.billing_workers),
+        }
+        # база заполняется прямо отсюда, до импорта bd
+        os.environ["DATABASE_NAME"] = self.env["DATABASE_NAME"]
+        sys.path.insert(0, ROOT)
+
+    def start(self, name, *command):
+        log = open(os.path.join(self.dir, f"{name}.log"), 'w')
+        self.processes.append(subprocess.Popen(
+            [sys.executable, *command], cwd=ROOT, env=self.env,
+            stdout=log, stderr=subprocess.STDOUT))
+
+    def up(self):
+        args = self.args
+        subprocess.run([sys.executable, 'bd.py'], cwd=ROOT, env=self.env, check=True,
+                       stdout=subprocess.DEVNULL)
+        self.start('fake_yookassa', os.path.join(BENCHMARKS, 'fake_yookassa.py'),
+                   '--port', str(args.base_port),
+                   '--latency', str(args.gateway_latency),
+                   '--failure-rate', str(args.gateway_failure_rate),
+                   '--duplicate-rate', str(args.duplicate_rate),
+                   '--webhook-url', f"{self.notify}/webhook")
+        self.start('fake_telegram', os.path.join(BENCHMARKS, 'fake_telegram.py'),
+                   '--port', str(args.base_port + 1),
+                   '--latency', str(args.telegram_latency))
+        for name, port in (('server', args.base_port + 2), ('notify-bot', args.base_port + 3)):
+            self.start(name, '-m', 'uvicorn', f"{name}:app", '--host', '127.0.0.1',
+                       '--port', str(port), '--log-level', 'warning')
+        for i in range(args.schedulers):
+            self.env["SCHEDULER_METRICS_PORT"] = str(args.base_port + 4 + i)
+            self.start(f"scheduler-{i}", 'scheduler.py')
+        print(f"Logs and database in {self.dir}")
+
+    def down(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    async def wait_ready(self, client):
+        deadline = time.monotonic() + 60
+        for url in (f"{self.gateway}/stats", f"{self.telegram}/stats",
+                    f"{self.server}/metrics", f"{self.notify}/metrics",
+                    *(f"{url}/metrics" for url in self.schedulers)):
+            while True:
+                try:
+                    if (await client.get(url)).status_code == 200:
+                        break
+                except httpx.HTTPError:
+                    pass
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"{url} did not start, see logs in {self.dir}")
+                await asyncio.sleep(0.2)
+
+    async def drain(self, client, timeout):
+        """Ждёт, пока шлюз отправит вебхуки, а notify-bot разберёт inbox"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            pending = (await client.get(f"{self.gateway}/stats")).json()['webhooks_pending']
+            samples = await scrape(client, self.notify)
+            if not pending and not gauge(samples, 'queue_depth', queue='webhook_inbox'):
+                return samples
+            await asyncio.sleep(0.2)
+        print(f"  not drained in {timeout:.0f} s")
+        return await scrape(client, self.notify)
+
+
+async def bounded(count, concurrency, request):
+    """count запросов не более чем по concurrency одновременно; задержки в секундах"""
+    latencies = []
+    queue = iter(range(count))
+
+    async def worker():
+        for i in queue:
+            start = time.perf_counter()
+            await request(i)
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies
+
+
+async def processing_report(stand, client, before, started):
+    after = await stand.drain(client, stand.args.drain_timeout)
+    elapsed = time.perf_counter() - started
+    events = (buckets(after, 'webhook_processing_duration_seconds').get('+Inf', 0)
+              - buckets(before, 'webhook_processing_duration_seconds').get('+Inf', 0))
+    report("  webhook processing", int(events), elapsed,
+           histogram_quantile(before, after, 'webhook_processing_duration_seconds', 0.5),
+           histogram_quantile(before, after, 'webhook_processing_duration_seconds', 0.99))
+    telegram = (await client.get(f"{stand.telegram}/stats")).json()
+    print(f"  telegram: {telegram['messages']} messages sent, "
+          f"outbox {gauge(after, 'queue_depth', queue='notification_outbox'):.0f} waiting")
+
+
+async def orders(stand, client):
+    args = stand.args
+    before = await scrape(client, stand.notify)
+    started = time.perf_counter()
+    latencies = await bounded(args.orders, args.concurrency, lambda i: client.post(
+        f"{stand.server}/api/create_order",
+        json={"chat_id": random.randint(1, args.chats), "product": "Product 1"}))
+    report("orders", len(latencies), time.perf_counter() - started,
+           percentile(latencies, 0.5), percentile(latencies, 0.99))
+    await processing_report(stand, client, before, started)
+
+
+def webhook(event, obj):
+    return {"type": "notification", "event": event, "object": obj}
+
+
+async def webhooks(stand, client):
+    args = stand.args
+    events = [webhook("payment.succeeded", {
+        "id": str(uuid.uuid4()),
+        "status": "succeeded",
+        "amount": {"value": "100.00", "currency": "RUB"},
+        "description": "product:Product 1",
+        "merchant_customer_id": str(random.randint(1, args.chats)),
+        "payment_method": {"id": str(uuid.uuid4()), "saved": False},
+    }) for _ in range(args.webhooks)]
+    # повторные доставки тех же событий, как при ретраях YooKassa
+    events += random.sample(events, int(len(events) * args.duplicate_rate))
+    random.shuffle(events)
+    before = await scrape(client, stand.notify)
+    started = time.perf_counter()
+    latencies = await bounded(len(events), args.concurrency, lambda i: client.post(
+        f"{stand.notify}/webhook", json=events[i]))
+    report("webhook ack", len(latencies), time.perf_counter() - started,
+           percentile(latencies, 0.5), percentile(latencies, 0.99))
+    await processing_report(stand, client, before, started)
+
+
+async def refunds(stand, client):
+    import bd
+    args = stand.args
+    now = datetime.now().isoformat()
+    paid = [(str(uuid.uuid4()), str(random.randint(1, args.chats))) for _ in range(args.refunds)]
+    with bd.get_connection() as conn:
+        conn.executemany('''
+            INSERT INTO payments (id, chat_id, amount, currency, status, description,
+                                  payment_method_id, is_recurrent, created_at)
+            VALUES (?, ?, 100.0, 'RUB', 'succeeded', 'product:Product 1', NULL, false, ?)
+        ''', [(id, chat_id, now) for id, chat_id in paid])
+    before = await scrape(client, stand.notify)
+    started = time.perf_counter()
+    latencies = await bounded(len(paid), args.concurrency, lambda i: client.post(
+        f"{stand.server}/api/refund",
+        json={"order_id": paid[i][0], "chat_id": int(paid[i][1])}))
+    report("refunds", len(latencies), time.perf_counter() - started,
+           percentile(latencies, 0.5), percentile(latencies, 0.99))
+    await processing_report(stand, client, before, started)
+
+
+def billing_progress(conn, due, paid_before):
+    """(ещё не списано, списание завершено, число подписок по состояниям).
+
+    Подписка в charging только взята репликой; завершённое списание сдвигает
+    last_payment или, при ошибке, переводит подписку в retry_scheduled."""
+    import bd
+    pending = conn.execute(f'''
+        SELECT COUNT(*) FROM subscriptions
+        WHERE state = 'charging'
+           OR (state IN ({bd._states(bd.SUBSCRIPTION_DUE_STATES)}) AND next_due_at <= ?)
+    ''', (due,)).fetchone()[0]
+    charged = conn.execute('''
+        SELECT COUNT(*) FROM subscriptions
+        WHERE last_payment > ? OR state = 'retry_scheduled'
+    ''', (paid_before,)).fetchone()[0]
+    states = dict(conn.execute('SELECT state, COUNT(*) FROM subscriptions GROUP BY state'))
+    return pending, charged, states
+
+
+async def billing(stand, client):
+    import bd
+    args = stand.args
+    now = datetime.now()
+    due = now.isoformat()
+    paid_before = (now - timedelta(days=30)).isoformat()
+    # следующий период - через 30 дней, чтобы за время теста подписки не повторялись
+    with bd.get_connection() as conn:
+        conn.executemany('''
+            INSERT INTO subscriptions (payment_method_id, chat_id, saved, last_payment,
+                last_error_message, started, interval, amount, currency, description,
+                next_due_at)
+            VALUES (?, ?, true, ?, NULL, ?, 2592000, 100.0, 'RUB', 'product:Product 1', ?)
+        ''', ((str(uuid.uuid4()), str(i % args.chats + 1), paid_before, due, due)
+              for i in range(args.subscriptions)))
+    before = await scrape_all(client, stand.schedulers)
+    started = time.perf_counter()
+    deadline = time.monotonic() + args.drain_timeout
+    while time.monotonic() < deadline:
+        pending, charged, states = billing_progress(conn, due, paid_before)
+        if not pending:
+            break
+        await asyncio.sleep(0.5)
+    elapsed = time.perf_counter() - started
+    after = await scrape_all(client, stand.schedulers)
+    pending, charged, states = billing_progress(conn, due, paid_before)
+    report("billing charges", charged, elapsed,
+           histogram_quantile(before, after, 'recurrent_charge_duration_seconds', 0.5),
+           histogram_quantile(before, after, 'recurrent_charge_duration_seconds', 0.99))
+    print(f"  scheduler lag p50 "
+          f"{histogram_quantile(before, after, 'recurrent_scheduler_lag_seconds', 0.5):.2f} s, "
+          f"p99 {histogram_quantile(before, after, 'recurrent_scheduler_lag_seconds', 0.99):.2f} s")
+    print(f"  subscriptions by state {states}, not finished {pending}")
+
+
+SCENARIOS = {"orders": orders, "webhooks": webhooks, "refunds": refunds, "billing": billing}
+
+
+async def run(stand):
+    async with httpx.AsyncClient(timeout=60, limits=httpx.Limits(
+            max_connections=stand.args.concurrency * 2)) as client:
+        await stand.wait_ready(client)
+        for name in stand.args.scenarios.split(','):
+            await SCENARIOS[name](stand, client)
+        gateway = (await client.get(f"{stand.gateway}/stats")).json()
+        print(f"gateway: {gateway}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default='orders,webhooks,refunds,billing')
+    parser.add_argument('--base-port', type=int, default=5201,
+                        help='шлюз, Telegram, server.py, notify-bot.py на портах подряд')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--chats', type=int, default=1000)
+    parser.add_argument('--orders', type=int, default=2000)
+    parser.add_argument('--webhooks', type=int, default=5000)
+    parser.add_argument('--refunds', type=int, default=1000)
+    parser.add_argument('--subscriptions', type=int, default=100000)
+    parser.add_argument('--schedulers', type=int, default=2,
+                        help='реплик scheduler.py')
+    parser.add_argument('--billing-workers', type=int, default=32,
+                        help='RECURRENT_PAYMENT_WORKERS каждой реплики')
+    parser.add_argument('--gateway-latency', type=float, default=0.05)
+    parser.add_argument('--gateway-failure-rate', type=float, default=0.0)
+    parser.add_argument('--duplicate-rate', type=float, default=0.05,
+                        help='доля вебхуков, доставленных повторно')
+    parser.add_argument('--telegram-latency', type=float, default=0.03)
+    parser.add_argument('--telegram-rps', type=float, default=25,
+                        help='TELEGRAM_GLOBAL_RPS для notify-bot')
+    parser.add_argument('--drain-timeout', type=float, default=1800)
+    args = parser.parse_args()
+
+    stand = Stand(args)
+    stand.up()
+    try:
+        asyncio.run(run(stand))
+    finally:
+        stand.down()
+
+
+if __name__ == '__main__':
+    main()
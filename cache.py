@@ -0,0 +1,67 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """LRU кэш со временем жизни записей и счётчиками попаданий/промахов"""
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # растёт при каждой инвалидации, чтобы не сохранить значение,
+        # прочитанное до параллельной записи
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_load(self, key, load):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self.generation
+        value = load()
+        with self.lock:
+            if generation == self.generation:
+                self.entries[key] = (time.monotonic() + self.ttl, value)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key):
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(key, None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self.entries)}
+
+
+class RecentKeys:
+    """LRU множество последних ключей для быстрого отсева повторов"""
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key) -> bool:
+        with self.lock:
+            if key in self.keys:
+                self.keys.move_to_end(key)
+                return True
+            return False
+
+    def add(self, key):
+        with self.lock:
+            self.keys[key] = None
+            self.keys.move_to_end(key)
+            while len(self.keys) > self.maxsize:
+                self.keys.popitem(last=False)
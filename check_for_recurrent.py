@@ -1,122 +1,290 @@
 #!/usr/bin/env python3
 
 import logging
+import math
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
 from datetime import datetime, timedelta
-import threading
 import time
+import uuid
 from fastapi import FastAPI, HTTPException, status
-import requests
-from yookassa_api import PaymentProcessor
+from yookassa_api import GatewayUnavailable, PaymentProcessor
+from circuit_breaker import CLOSED
+from rate_limiter import RateLimiter
 import bd
+import metrics
+import tracing
 import os
 
 logger = logging.getLogger(__name__)
 
-RECURRENT_PAYMENT_CHECK_INTERVAL = os.environ["RECURRENT_PAYMENT_CHECK_INTERVAL"]
-RECURRENT_PAYMENT_RETRY_FAILED_PAYMENT_INTERVAL = os.environ["RECURRENT_PAYMENT_RETRY_FAILED_PAYMENT_INTERVAL"]
-NOTIFICATION_API_URL = os.environ["NOTIFICATION_API_URL"]
+# максимальное время сна: новые подписки добавляет notify-bot из другого процесса
+RECURRENT_PAYMENT_CHECK_INTERVAL = float(os.environ["RECURRENT_PAYMENT_CHECK_INTERVAL"])
+RECURRENT_PAYMENT_RETRY_FAILED_PAYMENT_INTERVAL = float(os.environ["RECURRENT_PAYMENT_RETRY_FAILED_PAYMENT_INTERVAL"])
+RECURRENT_PAYMENT_MIN_SLEEP = 1
+# через сколько повторить списание, если шлюз не ответил (ключ идемпотентности тот же)
+RECURRENT_PAYMENT_GATEWAY_RETRY_INTERVAL = float(os.environ.get(
+    "RECURRENT_PAYMENT_GATEWAY_RETRY_INTERVAL", 60))
+# сколько ждать вебхук о платеже в статусе pending, прежде чем запросить его статус
+RECURRENT_PAYMENT_WEBHOOK_TIMEOUT = float(os.environ.get(
+    "RECURRENT_PAYMENT_WEBHOOK_TIMEOUT", 3600))
+# неудачных списаний подряд до остановки подписки; 0 - без ограничения
+RECURRENT_PAYMENT_MAX_FAILURES = int(os.environ.get("RECURRENT_PAYMENT_MAX_FAILURES", 10))
+# число параллельных списаний; 1 - последовательная обработка
+RECURRENT_PAYMENT_WORKERS = int(os.environ.get("RECURRENT_PAYMENT_WORKERS", 1))
+# сколько подписок реплика берёт за раз и на сколько секунд: аренда должна
+# переживать обработку всей пачки, иначе подписку заберёт другая реплика
+RECURRENT_PAYMENT_BATCH = int(os.environ.get("RECURRENT_PAYMENT_BATCH", 100))
+RECURRENT_PAYMENT_LEASE = float(os.environ.get("RECURRENT_PAYMENT_LEASE", 300))
+# доля пачки для повторов после ошибки: при разборе большой очереди повторы
+# не вытесняют первые попытки, но занимают место, которое те не использовали
+RECURRENT_PAYMENT_RETRY_SHARE = float(os.environ.get("RECURRENT_PAYMENT_RETRY_SHARE", 0.2))
+# списаний в секунду на реплику; 0 - без ограничения
+RECURRENT_PAYMENT_MAX_RPS = float(os.environ.get("RECURRENT_PAYMENT_MAX_RPS", 0))
+# как часто пересчитывать и писать в лог размер просроченной очереди
+RECURRENT_PAYMENT_PROGRESS_INTERVAL = float(os.environ.get(
+    "RECURRENT_PAYMENT_PROGRESS_INTERVAL", 30))
+
+SCHEDULER_LAG = metrics.Histogram(
+    "recurrent_scheduler_lag_seconds", "Delay between next_due_at and the charge attempt")
+RECURRENT_CHARGE_DURATION = metrics.Histogram(
+    "recurrent_charge_duration_seconds", "Duration of one recurrent charge")
+BACKLOG = metrics.Gauge("recurrent_backlog", "Overdue recurrent charges")
+BACKLOG_ETA = metrics.Gauge("recurrent_backlog_eta_seconds",
+                            "Estimated time to drain the backlog, -1 if it is not shrinking")
 # payment_processor = yookassa_api.PaymentProcessor(SHOP_ID, API_KEY, URL)
 
 
+def billing_idempotence_key(subscription: dict) -> str:
+    """Ключ идемпотентности попытки списания за текущий период.
+
+    Период задаёт last_payment, попытку - время последней окончательной ошибки:
+    пока ни одно из них не изменилось, повторный запрос (после таймаута или
+    перезапуска) вернёт уже созданный платёж, а не спишет деньги ещё раз."""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, ":".join([
+        subscription['payment_method_id'],
+        str(subscription['last_payment']),
+        str(subscription['last_error_message'])])))
+
+
+def webhook_check_at() -> str:
+    return (datetime.now() + timedelta(seconds=RECURRENT_PAYMENT_WEBHOOK_TIMEOUT)).isoformat()
+
+
+def recheck_charge(subscription: dict, payment_processor: PaymentProcessor):
+    """Статус платежа, по которому не пришёл вебхук, или None, если узнать его
+    не удалось и перепроверка отложена. Платёж не создаётся заново: запрос с тем
+    же ключом вернул бы прежний pending, а через сутки, когда YooKassa забудет
+    ключ, - списал бы деньги второй раз."""
+    try:
+        return payment_processor.get_payment(subscription['charge_id'])
+    except GatewayUnavailable:
+        raise
+    except Exception as e:
+        logger.error(f"Charge {subscription['charge_id']} lookup failed: {str(e)}")
+        bd.await_subscription_webhook(
+            subscription['payment_method_id'], webhook_check_at(), subscription['charge_id'],
+            worker=subscription['claimed_by'])
+        return None
+
+
+@RECURRENT_CHARGE_DURATION.time()
+@tracing.background("recurrent charge")
 def process_recurrent_payment(subscription: dict, payment_processor: PaymentProcessor):
     """Обработка одного рекуррентного платежа"""
     try:
-        # Вызов API для создания рекуррентного платежа
-        order = payment_processor.create_payment(
-            subscription['amount'],
-            'RUB',
-            subscription['description'],
-            subscription['chat_id'],
-            False,
-            subscription['payment_method_id'],
-            metadata={'payment_interval': subscription['interval'],
-                      'chat_id': subscription['chat_id']})
+        if subscription['charge_id']:
+            order = recheck_charge(subscription, payment_processor)
+            if order is None:
+                return
+        else:
+            # Вызов API для создания рекуррентного платежа
+            order = payment_processor.create_payment(
+                subscription['amount'],
+                'RUB',
+                subscription['description'],
+                subscription['chat_id'],
+                False,
+                subscription['payment_method_id'],
+                metadata={'payment_interval': subscription['interval'],
+                          'chat_id': subscription['chat_id']},
+                idempotence_key=billing_idempotence_key(subscription))
 
         if not order or order['status'] == 'canceled':
-            bd.update_subscription_error(
-                time=datetime.now().isoformat(),
-                payment_id=subscription['payment_method_id'])
-            update_subscription_error(
-                subscription, 'order cancelled',
-                message_type="error" if not order else "failure")
+            mark_failed(subscription, 'order cancelled')
+            update_subscription_error(subscription, 'order cancelled')
+        elif order['status'] == 'succeeded':
+            charge_succeeded(subscription, order)
         else:
-            bd.update_subscription_success(
-                datetime.now().isoformat(), subscription['payment_method_id'])
+            # pending: итог придёт вебхуком в notify-bot
+            bd.await_subscription_webhook(
+                subscription['payment_method_id'], webhook_check_at(), order['id'],
+                worker=subscription['claimed_by'])
 
+    except GatewayUnavailable as e:
+        # Результат неизвестен: повторяем скоро и с тем же ключом (или той же
+        # перепроверкой charge_id), ошибку не фиксируем. Срок next_due_at
+        # остаётся прежним, чтобы после восстановления шлюза подписка не
+        # потеряла место среди самых просроченных
+        logger.warning(f"Gateway unavailable, charge deferred: {str(e)}")
+        bd.reschedule_subscription(
+            subscription['payment_method_id'],
+            (datetime.now() + timedelta(
+                seconds=RECURRENT_PAYMENT_GATEWAY_RETRY_INTERVAL)).isoformat(),
+            worker=subscription['claimed_by'])
     except Exception as e:
         logger.error(f"Payment error: {str(e)}")
-        update_subscription_error(subscription['payment_method_id'])
+        mark_failed(subscription, str(e))
+        update_subscription_error(subscription, str(e))
+
 
+def charge_succeeded(subscription: dict, order: dict):
+    """Списание прошло. Если это подтвердила перепроверка, вебхук мог
+    потеряться: его событие добавляется в inbox, и notify-bot, как для
+    настоящего вебхука (save_payment_d), запишет платёж в payments и
+    уведомит пользователя. Повторный вебхук inbox отбросит."""
+    now = datetime.now().isoformat()
+    if subscription['charge_id']:
+        bd.inbox_replay([bd.webhook_event(bd.PAYMENT_EVENTS, order)], now)
+    bd.update_subscription_success(now, subscription['payment_method_id'],
+                                   worker=subscription['claimed_by'])
 
-def update_subscription_error(subscription: dict, error_message: str = '',
-                              message_type: str = 'error'):
-    """Обновление подписки при ошибке и отправка уведомления"""
+
+def mark_failed(subscription: dict, error: str):
+    """Запоминает ошибку и переносит следующую попытку на интервал повтора
+    (после RECURRENT_PAYMENT_MAX_FAILURES неудач подряд подписка останавливается)"""
+    now = datetime.now()
+    bd.update_subscription_error(
+        time=now.isoformat(),
+        payment_id=subscription['payment_method_id'],
+        retry_at=(now + timedelta(
+            seconds=RECURRENT_PAYMENT_RETRY_FAILED_PAYMENT_INTERVAL)).isoformat(),
+        error=error,
+        max_failures=RECURRENT_PAYMENT_MAX_FAILURES,
+        worker=subscription['claimed_by'])
+
+
+def update_subscription_error(subscription: dict, error_message: str = ''):
+    """Уведомление о неудачном списании через outbox notify-bot: оно
+    переживёт перезапуск и уйдёт с учётом лимитов Telegram"""
+    now = datetime.now()
     try:
-        # Отправка уведомления через REST API
-        notification_data = {
-            "chat_id": subscription['chat_id'],
-            "message_type": message_type,
-            "details": {
-                "payment_id": subscription['payment_method_id'],
-                "error": error_message,
-                "amount": subscription['amount'],
-                "currency": subscription['currency']
-            }
-        }
-
-        requests.post(
-            f"{NOTIFICATION_API_URL}/send-notification",
-            json=notification_data,
-            timeout=5
-        )
-
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to send notification: {str(e)}")
+        bd.outbox_insert(
+            chat_id=subscription['chat_id'],
+            text=f"❌ {now} Payment failed! Reason: {error_message or 'Unknown error'}",
+            parse_mode=None,
+            created_at=now.isoformat())
     except Exception as e:
-        logger.error(f"Subscription update error: {str(e)}")
+        logger.error(f"Failed to queue notification: {str(e)}")
 
 def dict_factory(cursor, row):
     fields = [column[0] for column in cursor.description]
     return {key: value for key, value in zip(fields, row)}
 
-def check_recurrent_payments(payment_processor):
-    """Проверка и обработка рекуррентных платежей"""
+def seconds_until_next_due() -> float:
+    """Сколько спать до ближайшего срока списания"""
+    next_due_at = bd.get_next_due_at()
+    if next_due_at is None:
+        return RECURRENT_PAYMENT_CHECK_INTERVAL
+    delay = (datetime.fromisoformat(next_due_at) - datetime.now()).total_seconds()
+    return min(max(delay, RECURRENT_PAYMENT_MIN_SLEEP), RECURRENT_PAYMENT_CHECK_INTERVAL)
+
+class BacklogProgress:
+    """Размер просроченной очереди (всех реплик) и оценка времени её разбора"""
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.checked_at = None
+        self.size = 0
+        self.rate = None  # подписок в секунду, сглаженное
+
+    def update(self):
+        now = time.monotonic()
+        if self.checked_at is not None and now - self.checked_at < self.interval:
+            return
+        backlog = bd.get_backlog(datetime.now().isoformat())
+        size = backlog['first'] + backlog['retry']
+        if self.checked_at is not None:
+            # чистая скорость: списанные минус ставшие просроченными
+            rate = (self.size - size) / (now - self.checked_at)
+            self.rate = rate if self.rate is None else (self.rate + rate) / 2
+        self.checked_at, self.size = now, size
+        eta = size / self.rate if self.rate and self.rate > 0 else -1
+        BACKLOG.set(backlog['first'], kind="first")
+        BACKLOG.set(backlog['retry'], kind="retry")
+        BACKLOG_ETA.set(eta if size else 0)
+        if size:
+            logger.info(
+                f"Backlog: {backlog['first']} first attempts, {backlog['retry']} retries, "
+                f"oldest due {backlog['oldest']}, "
+                + (f"draining at {self.rate:.1f}/s, ETA {eta:.0f}s" if eta >= 0
+                   else "not shrinking"))
+
+
+def claim_batch(worker: str, batch: int) -> list:
+    """Пачка подписок от самых просроченных; повторы получают свою долю пачки
+    и то, что осталось от первых попыток"""
+    now = datetime.now()
+    due, lease = now.isoformat(), (now + timedelta(seconds=RECURRENT_PAYMENT_LEASE)).isoformat()
+    retry_budget = math.ceil(batch * RECURRENT_PAYMENT_RETRY_SHARE)
+    claimed = bd.claim_due_subscriptions(worker, due, lease, retry_budget, retries=True)
+    claimed += bd.claim_due_subscriptions(worker, due, lease, batch - len(claimed))
+    if len(claimed) < batch:
+        claimed += bd.claim_due_subscriptions(worker, due, lease, batch - len(claimed),
+                                              retries=True)
+    return sorted(claimed, key=lambda sub: sub['next_due_at'])
+
+
+def check_recurrent_payments(payment_processor, worker: str):
+    """Проверка и обработка рекуррентных платежей.
+
+    Реплик может быть несколько: каждая берёт подписки в аренду под своим
+    именем worker, поэтому одну подписку не списывают дважды. Если реплика
+    упала, её подписки заберут другие после RECURRENT_PAYMENT_LEASE, а
+    повторный запрос уйдёт с тем же ключом идемпотентности.
+    После простоя очередь разбирается от самых просроченных списаний с
+    частотой не выше RECURRENT_PAYMENT_MAX_RPS."""
+    # Частоту запросов к шлюзу ограничивает сам payment_processor (max_rps)
+    executor = ThreadPoolExecutor(max_workers=RECURRENT_PAYMENT_WORKERS,
+                                  thread_name_prefix="recurrent-payment")
+    batch = RECURRENT_PAYMENT_BATCH
+    charge_limiter = None
+    if RECURRENT_PAYMENT_MAX_RPS:
+        charge_limiter = RateLimiter(RECURRENT_PAYMENT_MAX_RPS)
+        # пачка должна успеть списаться за половину аренды
+        batch = max(1, min(batch, int(RECURRENT_PAYMENT_MAX_RPS * RECURRENT_PAYMENT_LEASE / 2)))
+
+    def charge(subscription: dict):
+        if charge_limiter:
+            charge_limiter.acquire()
+        process_recurrent_payment(subscription, payment_processor)
+
+    progress = BacklogProgress(RECURRENT_PAYMENT_PROGRESS_INTERVAL)
+    breaker = payment_processor.circuit_breaker
     while True:
+        # Пока шлюз недоступен, подписки не трогаем: они останутся в очереди
+        if wait := breaker.retry_in():
+            logger.warning(f"Payment gateway circuit open, charges deferred for {wait:.0f}s")
+            time.sleep(min(wait, RECURRENT_PAYMENT_CHECK_INTERVAL))
+            continue
+        # Размыкатель пропустит только пробные вызовы: остальные подписки
+        # пачки пришлось бы сразу откладывать
+        size = batch if breaker.state == CLOSED else min(batch, breaker.half_open_calls)
         try:
-            subscriptions = bd.get_active_subscriptions()
-            print("active and not failed subscriptions:", len(subscriptions))
+            progress.update()
+            # Только подписки, срок которых наступил: active, retry_scheduled и
+            # awaiting_webhook, чей вебхук так и не пришёл
+            subscriptions = claim_batch(worker, size)
+            logger.info(f"Claimed {len(subscriptions)} due subscriptions")
+            now = datetime.now()
             for sub in subscriptions:
-                logger.info(dict(sub))
-                now = datetime.now()
-                last_payment = datetime.fromisoformat(sub['last_payment'])
-                next_payment = last_payment + timedelta(seconds=sub['interval'])
-
-                # Проверка необходимости оплаты
-                if now >= next_payment:
-                    print('payment incoming')
-                    process_recurrent_payment(dict(sub), payment_processor)
-                else:
-                    print(f'not yet: {now} {next_payment}')
-            # Проверка подписок с ошибками
-            failed_subs = bd.get_failed_subscriptions()
-            print("failed subscriptions:", len(failed_subs))
-            for sub in failed_subs:
-                error_time = datetime.fromisoformat(sub['last_error_message'])
-                if (
-                        (datetime.now() - error_time).total_seconds() >=
-                        RECURRENT_PAYMENT_RETRY_FAILED_PAYMENT_INTERVAL
-                ):
-                    process_recurrent_payment(dict(sub), payment_processor)
-
+                SCHEDULER_LAG.observe(
+                    (now - datetime.fromisoformat(sub['next_due_at'])).total_seconds())
+            # Ждём всю пачку: аренда снимается после обработки каждой подписки
+            list(executor.map(charge, subscriptions))
+            # полная пачка - вероятно, есть ещё просроченные подписки
+            delay = 0 if len(subscriptions) == size else seconds_until_next_due()
         except Exception as e:
             logger.error(f"Recurrent check error: {str(e)}")
+            delay = RECURRENT_PAYMENT_CHECK_INTERVAL
 
-        time.sleep(RECURRENT_PAYMENT_CHECK_INTERVAL)
-
-def start_recurrent_checker(payment_processor):
-    """Запуск фонового потока для проверки платежей"""
-    thread = threading.Thread(
-        target=check_recurrent_payments, args=[payment_processor], daemon=True)
-    thread.start()
-    logger.info("Recurrent payments checker started")
+        time.sleep(delay)
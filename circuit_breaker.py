@@ -0,0 +1,84 @@
+import threading
+import time
+from collections import deque
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Размыкается, когда доля ошибок среди последних window вызовов превышает
+    failure_rate; через open_timeout пропускает half_open_calls пробных вызовов
+    и замыкается, если они успешны. Проба, не завершившаяся за open_timeout
+    (вызов отменён, не дойдя до record_*), больше не занимает слот."""
+    def __init__(self, window: int = 20, min_calls: int = 10, failure_rate: float = 0.5,
+                 open_timeout: float = 30, half_open_calls: int = 1):
+        self.window = deque(maxlen=window)
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_timeout = open_timeout
+        self.half_open_calls = half_open_calls
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probes = 0
+        self.probe_started = 0.0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.open_timeout:
+                    self.rejected += 1
+                    return False
+                self.state = HALF_OPEN
+                self.probes = 0
+            if self.state == HALF_OPEN:
+                if self.probes >= self.half_open_calls:
+                    if time.monotonic() - self.probe_started < self.open_timeout:
+                        self.rejected += 1
+                        return False
+                    self.probes = 0
+                self.probes += 1
+                self.probe_started = time.monotonic()
+            return True
+
+    def retry_in(self) -> float:
+        """Сколько ждать до пробного вызова (0 - вызовы разрешены)"""
+        with self.lock:
+            if self.state == HALF_OPEN and self.probes >= self.half_open_calls:
+                return max(self.open_timeout - (time.monotonic() - self.probe_started), 0)
+            if self.state != OPEN:
+                return 0
+            return max(self.open_timeout - (time.monotonic() - self.opened_at), 0)
+
+    def record_success(self):
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.state = CLOSED
+                self.window.clear()
+            self.window.append(True)
+
+    def record_failure(self):
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self._open()
+                return
+            self.window.append(False)
+            failures = self.window.count(False)
+            if (len(self.window) >= self.min_calls and
+                    failures / len(self.window) >= self.failure_rate):
+                self._open()
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.window.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"state": self.state,
+                    "window_calls": len(self.window),
+                    "window_failures": self.window.count(False),
+                    "rejected": self.rejected}
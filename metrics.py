@@ -0,0 +1,119 @@
+"""Метрики в текстовом формате Prometheus без внешних зависимостей.
+
+Метрики регистрируются при создании и отдаются функцией render()
+на /metrics каждого FastAPI приложения.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+# секунды: от долей миллисекунды (SQLite) до десятков секунд (шлюз)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+
+REGISTRY = []
+
+
+def _labels(labels: dict, extra: dict = None) -> str:
+    labels = {**labels, **(extra or {})}
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total, count) in self.series.items():
+                labels = dict(key)
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_labels(labels, {'le': bound})} {bucket_count}")
+                lines.append(f"{self.name}_bucket{_labels(labels, {'le': '+Inf'})} {count}")
+                lines.append(f"{self.name}_sum{_labels(labels)} {total}")
+                lines.append(f"{self.name}_count{_labels(labels)} {count}")
+        return lines
+
+
+class Gauge:
+    """Значение задаётся set() или вычисляется функцией при каждом render()"""
+    def __init__(self, name: str, help: str, function=None):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.values = {}
+        REGISTRY.append(self)
+
+    def set(self, value: float, **labels):
+        self.values[tuple(sorted(labels.items()))] = value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        values = dict(self.values)
+        if self.function is not None:
+            values[()] = self.function()
+        for key, value in values.items():
+            lines.append(f"{self.name}{_labels(dict(key))} {value}")
+        return lines
+
+
+class Counter:
+    """Монотонно растущее значение (имя с суффиксом _total): inc() или
+    функция, вычисляемая при каждом render()"""
+    def __init__(self, name: str, help: str, function=None):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = dict(self.values)
+        if self.function is not None:
+            values[()] = self.function()
+        for key, value in values.items():
+            lines.append(f"{self.name}{_labels(dict(key))} {value}")
+        return lines
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -1,16 +1,83 @@
 from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
+from contextlib import asynccontextmanager
+import asyncio
+import json
 import traceback
 import datetime
 import logging
 from telegram import Bot
+from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
 from typing import Dict, Any
 from pprint import pprint
+from rate_limiter import RateLimiter
+from cache import RecentKeys
 import bd
+import bd_async
+import metrics
+import tracing
 import os
 TELEGRAM_BOT_TOKEN = os.environ["TELEGRAM_BOT_TOKEN"]
+TELEGRAM_CONNECTION_POOL_SIZE = int(os.environ.get("TELEGRAM_CONNECTION_POOL_SIZE", 64))
+# переопределяется для нагрузочных тестов с локальной заглушкой Bot API
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org")
+# Обработчики входящих вебхуков
+INBOX_WORKERS = int(os.environ.get("INBOX_WORKERS", 4))
+INBOX_LEASE = float(os.environ.get("INBOX_LEASE", 60))  # s, потом событие заберут снова
+INBOX_RETRY_INTERVAL = float(os.environ.get("INBOX_RETRY_INTERVAL", 30))
+INBOX_MAX_ATTEMPTS = int(os.environ.get("INBOX_MAX_ATTEMPTS", 10))
+INBOX_POLL_INTERVAL = float(os.environ.get("INBOX_POLL_INTERVAL", 1))
+# inbox служит журналом полученных событий: хранится дольше окна повторов YooKassa
+INBOX_RETENTION = float(os.environ.get("INBOX_RETENTION", 7 * 24 * 3600))  # s
+INBOX_SEEN_KEYS = int(os.environ.get("INBOX_SEEN_KEYS", 100000))
+# Отправка уведомлений из outbox (лимиты Telegram: ~30 сообщений/с, ~1/с в один чат)
+OUTBOX_BATCH = int(os.environ.get("OUTBOX_BATCH", 100))
+OUTBOX_LEASE = float(os.environ.get("OUTBOX_LEASE", 60))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 8))
+OUTBOX_RETRY_BASE = float(os.environ.get("OUTBOX_RETRY_BASE", 2))  # s, удваивается
+OUTBOX_RETRY_MAX = float(os.environ.get("OUTBOX_RETRY_MAX", 600))
+TELEGRAM_GLOBAL_RPS = float(os.environ.get("TELEGRAM_GLOBAL_RPS", 25))
+TELEGRAM_CHAT_RPS = float(os.environ.get("TELEGRAM_CHAT_RPS", 1))
+TELEGRAM_MESSAGE_LIMIT = 4096
+# отменённое списание по подписке: те же настройки, что у scheduler.py
+RECURRENT_PAYMENT_RETRY_FAILED_PAYMENT_INTERVAL = float(os.environ.get(
+    "RECURRENT_PAYMENT_RETRY_FAILED_PAYMENT_INTERVAL", 3600))
+RECURRENT_PAYMENT_MAX_FAILURES = int(os.environ.get("RECURRENT_PAYMENT_MAX_FAILURES", 10))
 
-app = FastAPI()
+WEBHOOK_ACK_DURATION = metrics.Histogram(
+    "webhook_ack_duration_seconds", "Time to persist and acknowledge a webhook")
+WEBHOOK_PROCESSING_DURATION = metrics.Histogram(
+    "webhook_processing_duration_seconds", "Time to process an inbox event")
+TELEGRAM_SEND_DURATION = metrics.Histogram(
+    "telegram_send_duration_seconds", "Duration of Telegram sendMessage calls")
+QUEUE_DEPTH = metrics.Gauge("queue_depth", "Events waiting in a queue")
+
+# Один клиент на всё время работы: get_me и HTTP соединения не повторяются на каждое сообщение
+bot = Bot(TELEGRAM_BOT_TOKEN, base_url=f"{TELEGRAM_API_URL}/bot",
+          request=HTTPXRequest(connection_pool_size=TELEGRAM_CONNECTION_POOL_SIZE))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    profiler = tracing.start_profiler()
+    await bot.initialize()
+    workers = [asyncio.create_task(inbox_worker()) for _ in range(INBOX_WORKERS)]
+    workers.append(asyncio.create_task(inbox_cleaner()))
+    workers.append(asyncio.create_task(notification_dispatcher()))
+    yield
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    await bot.shutdown()
+    bd_async.shutdown()
+    tracing.stop_profiler(profiler)
+
+
+app = FastAPI(lifespan=lifespan)
+if tracing.TRACING:
+    app.middleware("http")(tracing.middleware)
 logger = logging.getLogger(__name__)
 
 # Database setup
@@ -21,12 +88,12 @@ class WebhookData(BaseModel):
     event: str
     object: Dict[str, Any]
 
-def save_payment_d(payment_data: Dict[str, Any]):
+async def save_payment_d(payment_data: Dict[str, Any]):
     try:
         payment_method = payment_data.get('payment_method', {})
         if not (chat_id := payment_data.get('merchant_customer_id')):
             chat_id = payment_data.get('metadata', {}).get('chat_id')
-        bd.payments_insert(
+        await bd_async.payments_insert(
             id=payment_data.get('id'),
             chat_id=chat_id,
             price=payment_data.get('amount', {}).get('value'),
@@ -38,12 +105,9 @@ def save_payment_d(payment_data: Dict[str, Any]):
             created_at=datetime.datetime.now().isoformat()
         )
         if payment_method.get('saved'):
-            locate = bd.get_orders(
-                search_name='payment_method_id',
-                search_id=payment_method.get('id'),
-                table='subscriptions')
+            locate = await bd_async.get_subscription(payment_method.get('id'))
             if not locate:
-                bd.subscriptions_insert(
+                await bd_async.subscriptions_insert(
                     payment_method_id=payment_method.get('id'),
                     chat_id=chat_id,
                     saved=True,
@@ -57,15 +121,34 @@ def save_payment_d(payment_data: Dict[str, Any]):
                 )
                 print('saved recurrent added to database')
             else:
-                print('saved recurrent already in database')
+                # списание по подписке: charging/awaiting_webhook -> active,
+                # в остальных состояниях подписка не меняется
+                await bd_async.update_subscription_success(
+                    datetime.datetime.now().isoformat(), payment_method.get('id'))
     except Exception as e:
         logger.error(f"Database error: {traceback.format_exception(e)}")
+        raise
+
+async def cancel_subscription_charge(payment_data: Dict[str, Any]):
+    """Отменённое списание по подписке: повтор через интервал или остановка"""
+    payment_method_id = payment_data.get('payment_method', {}).get('id')
+    if not payment_method_id or not await bd_async.get_subscription(payment_method_id):
+        return
+    now = datetime.datetime.now()
+    retry_at = now + datetime.timedelta(seconds=RECURRENT_PAYMENT_RETRY_FAILED_PAYMENT_INTERVAL)
+    await bd_async.update_subscription_error(
+        time=now.isoformat(),
+        payment_id=payment_method_id,
+        retry_at=retry_at.isoformat(),
+        error=payment_data.get('cancellation_details', {}).get('reason', 'canceled'),
+        max_failures=RECURRENT_PAYMENT_MAX_FAILURES)
 
-def update_refund_status(payment_id: str):
+async def update_refund_status(payment_id: str):
     try:
-        bd.update_set_refund_status(payment_id)
+        await bd_async.update_set_refund_status(payment_id)
     except Exception as e:
         logger.error(f"Refund update error: {str(e)}")
+        raise
 
 def handle_payment_status(event_type: str, payment_data: Dict[str, Any]) -> str:
     chat_id = payment_data.get('merchant_customer_id')
@@ -96,58 +179,236 @@ def handle_payment_status(event_type: str, payment_data: Dict[str, Any]) -> str:
     return message, chat_id
 
 
+# будит обработчиков сразу после записи нового события
+inbox_ready = asyncio.Event()
+# недавно полученные события: повтор отсеивается без обращения к базе
+seen_events = RecentKeys(INBOX_SEEN_KEYS)
+
+
 @app.post("/webhook")
 async def process_webhook(request: Request):
+    with WEBHOOK_ACK_DURATION.time():
+        return await store_webhook(request)
+
+
+async def store_webhook(request: Request):
     try:
         webhook_data = await request.json()
         logger.info(f"Received webhook: {webhook_data}")
-
-        # Immediate response to prevent retries
-        response = {"status": "received"}
-
         event_type = webhook_data.get('event')
         payment_data = webhook_data.get('object', {})
 
-        # Save/update payment data
+        # Событие сохраняется и сразу подтверждается, обработка - в inbox_worker.
+        # Повторная доставка того же события отбрасывается по ключу
+        # (событие, id объекта, статус): сначала в памяти, затем уникальным индексом.
+        key = bd.webhook_event_key(event_type, payment_data)
+        if key in seen_events:
+            return {"status": "duplicate"}
+        inserted = await bd_async.inbox_insert(
+            event_key=key,
+            event=event_type,
+            payload=json.dumps(webhook_data),
+            received_at=datetime.datetime.now().isoformat())
+        seen_events.add(key)
+        if not inserted:
+            return {"status": "duplicate"}
+        inbox_ready.set()
+        return {"status": "received"}
+
+    except Exception as e:
+        logger.error(f"Webhook processing error: {traceback.format_exception(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def handle_webhook(webhook_data: Dict[str, Any]):
+    event_type = webhook_data.get('event')
+    payment_data = webhook_data.get('object', {})
+
+    # Save/update payment data
+    if event_type == "refund.succeeded":
+        await update_refund_status(payment_data.get('payment_id'))
+    elif event_type == "payment.succeeded":
+        await save_payment_d(payment_data)
+    elif event_type == "payment.canceled":
+        await cancel_subscription_charge(payment_data)
+
+    # Generate and send notification
+    message, chat_id = handle_payment_status(event_type, payment_data)
+    if chat_id is None:
+        chat_id = payment_data.get('metadata', {}).get('chat_id')
+    if chat_id is None:
+        logger.error(f"chat id is missing: {chat_id} {webhook_data}")
+        payment_id = payment_data.get('payment_id')
+        chat_id = (await bd_async.get_payment(payment_id))['chat_id']
+    else:
+        logger.error(f"chat id was received: {chat_id} {webhook_data}")
+    print(f'chat id: {chat_id}')
+    await enqueue_notification(chat_id, message, parse_mode="Markdown")
+
+
+async def inbox_worker():
+    """Обрабатывает события из inbox, как минимум один раз каждое"""
+    while True:
         try:
-            if event_type == "refund.succeeded":
-                update_refund_status(payment_data.get('payment_id'))
-            elif event_type == "payment.succeeded":
-                save_payment_data(payment_data)
+            now = datetime.datetime.now()
+            event = await bd_async.inbox_claim(
+                now=now.isoformat(),
+                locked_until=(now + datetime.timedelta(seconds=INBOX_LEASE)).isoformat())
+            if event is None:
+                inbox_ready.clear()
+                try:
+                    await asyncio.wait_for(inbox_ready.wait(), INBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await process_inbox_event(event)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            logger.error(f"Data processing error: {str(e)}")
+            # например, database is locked: событие останется в inbox до следующей попытки
+            logger.error(f"Inbox worker error: {traceback.format_exception(e)}")
+            await asyncio.sleep(INBOX_POLL_INTERVAL)
 
-        # Generate and send notification
-        message, chat_id = handle_payment_status(event_type, payment_data)
-        if chat_id is None:
-            chat_id = payment_data.get('metadata', {}).get('chat_id')
-        if chat_id is None:
-            logger.error(f"chat id is missing: {chat_id} {webhook_data}")
-            payment_id = payment_data.get('payment_id')
-            chat_id = bd.get_orders(search_name='id',
-                                    search_id=payment_id,
-                                    num='one')['chat_id']
-        else:
-            logger.error(f"chat id was received: {chat_id} {webhook_data}")
-        print(f'chat id: {chat_id}')
+
+async def process_inbox_event(event: dict):
+    try:
+        with tracing.background(f"inbox {event['event']}"), \
+                WEBHOOK_PROCESSING_DURATION.time(event=event['event']):
+            await handle_webhook(json.loads(event['payload']))
+            await bd_async.inbox_done(event['id'], datetime.datetime.now().isoformat())
+    except Exception as e:
+        logger.error(f"Inbox event {event['event_key']} failed: {traceback.format_exception(e)}")
+        retry_at = datetime.datetime.now() + datetime.timedelta(seconds=INBOX_RETRY_INTERVAL)
+        await bd_async.inbox_retry(event['id'], str(e), retry_at.isoformat(),
+                                   INBOX_MAX_ATTEMPTS)
+
+
+async def inbox_cleaner():
+    """Раз в час удаляет из inbox события старше INBOX_RETENTION"""
+    while True:
         try:
-            async with Bot(TELEGRAM_BOT_TOKEN) as bot:
-                await bot.send_message(
-                    chat_id=chat_id,
-                    text=message,
-                    parse_mode="Markdown"
-                )
+            before = datetime.datetime.now() - datetime.timedelta(seconds=INBOX_RETENTION)
+            if removed := await bd_async.inbox_purge(before.isoformat()):
+                logger.info(f"Purged {removed} processed webhook events")
         except Exception as e:
-            logger.error(f"Telegram send error: {str(e)}")
-        return response
+            logger.error(f"Inbox purge error: {str(e)}")
+        await asyncio.sleep(3600)
+
+
+outbox_ready = asyncio.Event()
+telegram_limiter = RateLimiter(TELEGRAM_GLOBAL_RPS)
+chat_limiters: Dict[str, RateLimiter] = {}
+# до какого момента Telegram попросил не отправлять (429 retry_after)
+telegram_paused_until = 0.0
+
+
+async def enqueue_notification(chat_id, text: str, parse_mode: str = None):
+    await bd_async.outbox_insert(chat_id=chat_id, text=text, parse_mode=parse_mode,
+                                 created_at=datetime.datetime.now().isoformat())
+    outbox_ready.set()
+
+
+def coalesce(notifications: list) -> list:
+    """Склеивает уведомления одного чата в сообщения не длиннее лимита Telegram"""
+    groups = []
+    current = {}
+    for n in notifications:
+        key = (n['chat_id'], n['parse_mode'])
+        group = current.get(key)
+        if group and len(group['text']) + 2 + len(n['text']) <= TELEGRAM_MESSAGE_LIMIT:
+            group['text'] += "\n\n" + n['text']
+            group['notifications'].append(n)
+        else:
+            group = {'chat_id': n['chat_id'], 'parse_mode': n['parse_mode'],
+                     'text': n['text'], 'notifications': [n]}
+            current[key] = group
+            groups.append(group)
+    return groups
+
+
+def chat_limiter(chat_id: str) -> RateLimiter:
+    if len(chat_limiters) > 10000:
+        # бакеты быстро наполняются заново, так что сброс безопасен
+        chat_limiters.clear()
+    if chat_id not in chat_limiters:
+        chat_limiters[chat_id] = RateLimiter(TELEGRAM_CHAT_RPS)
+    return chat_limiters[chat_id]
+
 
+def after(seconds: float) -> str:
+    return (datetime.datetime.now() + datetime.timedelta(seconds=seconds)).isoformat()
+
+
+async def deliver(group: dict):
+    with tracing.background("deliver"):
+        await deliver_group(group)
+
+
+async def deliver_group(group: dict):
+    global telegram_paused_until
+    ids = [n['id'] for n in group['notifications']]
+    if wait := chat_limiter(group['chat_id']).try_acquire():
+        await bd_async.outbox_postpone(ids, after(wait))
+        return
+    if (pause := telegram_paused_until - asyncio.get_running_loop().time()) > 0:
+        await asyncio.sleep(pause)
+    with tracing.span("telegram.rate_limit"):
+        await telegram_limiter.acquire_async()
+    try:
+        with TELEGRAM_SEND_DURATION.time(), tracing.span("telegram.send_message"):
+            await bot.send_message(chat_id=group['chat_id'], text=group['text'],
+                                   parse_mode=group['parse_mode'])
+        await bd_async.outbox_done(ids, datetime.datetime.now().isoformat())
+    except RetryAfter as e:
+        retry_after = e.retry_after
+        if isinstance(retry_after, datetime.timedelta):
+            retry_after = retry_after.total_seconds()
+        logger.warning(f"Telegram flood control, retry after {retry_after}s")
+        telegram_paused_until = asyncio.get_running_loop().time() + retry_after
+        await bd_async.outbox_postpone(ids, after(retry_after))
     except Exception as e:
-        logger.error(f"Webhook processing error: {traceback.format_exception(e)}")
-        return {"status": "error", "details": str(e)}
+        logger.error(f"Telegram send error: {str(e)}")
+        attempts = max(n['attempts'] for n in group['notifications'])
+        delay = min(OUTBOX_RETRY_BASE * 2 ** attempts, OUTBOX_RETRY_MAX)
+        await bd_async.outbox_retry(ids, str(e), after(delay), OUTBOX_MAX_ATTEMPTS)
+
+
+async def notification_dispatcher():
+    """Отправляет уведомления из outbox с учётом лимитов Telegram"""
+    while True:
+        try:
+            notifications = await bd_async.outbox_claim(
+                now=datetime.datetime.now().isoformat(),
+                locked_until=after(OUTBOX_LEASE), limit=OUTBOX_BATCH)
+            if not notifications:
+                outbox_ready.clear()
+                try:
+                    await asyncio.wait_for(outbox_ready.wait(), INBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await asyncio.gather(*(deliver(group) for group in coalesce(notifications)))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Notification dispatcher error: {traceback.format_exception(e)}")
+            await asyncio.sleep(INBOX_POLL_INTERVAL)
+
+
+
+
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    for queue, depth in (await bd_async.queue_depths()).items():
+        QUEUE_DEPTH.set(depth, queue=queue)
+    return metrics.render()
 
 
+@app.get("/cache-stats")
+async def cache_stats():
+    return bd.row_cache.stats()
 
 
 class NotificationRequest(BaseModel):
@@ -170,8 +431,7 @@ def construct_message(message_type: str, details: dict) -> str:
 async def send_notification(request: NotificationRequest):
     try:
         message = construct_message(request.message_type, request.details or {})
-        async with Bot(TELEGRAM_BOT_TOKEN) as bot:
-            await bot.send_message(chat_id=request.chat_id, text=message)
-        return {"status": "Message sent"}
+        await enqueue_notification(request.chat_id, message)
+        return {"status": "Message queued"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
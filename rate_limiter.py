@@ -0,0 +1,33 @@
+import asyncio
+import threading
+import time
+
+
+class RateLimiter:
+    """Token bucket: не более rate запросов в секунду, всплеск до burst"""
+    def __init__(self, rate: float, burst: int = None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self) -> float:
+        """Берёт токен без ожидания; возвращает 0 или сколько ждать до следующего"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while wait := self.try_acquire():
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        while wait := self.try_acquire():
+            await asyncio.sleep(wait)
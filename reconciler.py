@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""Сверка зависших платежей и возвратов со шлюзом - отдельный сервис.
+
+Платёж, созданный в server.create_order, и возврат из server.refund_order
+остаются pending, пока не придёт вебхук. Если вебхук потерялся, сервис раз в
+RECONCILE_INTERVAL находит такие строки старше RECONCILE_AFTER, спрашивает
+их статус у YooKassa (не больше RECONCILE_CONCURRENCY запросов одновременно)
+и применяет ответы одной транзакцией. Для окончательных статусов в inbox
+notify-bot добавляется то же событие, что прислал бы вебхук.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+import yookassa_api
+import bd
+import bd_async
+API_KEY = os.environ["API_KEY"]
+SHOP_ID = os.environ["SHOP_ID"]
+URL = os.environ["URL"]
+YOOKASSA_MAX_RPS = float(os.environ.get("YOOKASSA_MAX_RPS", 0))
+RECONCILE_INTERVAL = float(os.environ.get("RECONCILE_INTERVAL", 60))
+# сколько ждать вебхук, прежде чем спрашивать шлюз
+RECONCILE_AFTER = float(os.environ.get("RECONCILE_AFTER", 900))
+# через сколько переспросить о строке, которая всё ещё pending
+RECONCILE_RECHECK = float(os.environ.get("RECONCILE_RECHECK", 900))
+RECONCILE_BATCH = int(os.environ.get("RECONCILE_BATCH", 500))
+RECONCILE_CONCURRENCY = int(os.environ.get("RECONCILE_CONCURRENCY", 10))
+
+logger = logging.getLogger(__name__)
+
+
+async def fetch_all(fetch, ids: list) -> list:
+    """Объекты шлюза по id; None для тех, что получить не удалось"""
+    semaphore = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+
+    async def fetch_one(object_id):
+        async with semaphore:
+            try:
+                return await fetch(object_id)
+            except Exception as e:
+                logger.warning(f"Gateway lookup of {object_id} failed: {str(e)}")
+                return None
+
+    return await asyncio.gather(*(fetch_one(object_id) for object_id in ids))
+
+
+async def reconcile_once(payment_processor) -> bool:
+    """Один проход сверки; True, если стоит сразу сделать следующий"""
+    now = datetime.now()
+    stale_before = (now - timedelta(seconds=RECONCILE_AFTER)).isoformat()
+    checked_before = (now - timedelta(seconds=RECONCILE_RECHECK)).isoformat()
+    payments = await bd_async.get_stale_payments(stale_before, checked_before, RECONCILE_BATCH)
+    refunds = await bd_async.get_stale_refunds(stale_before, checked_before, RECONCILE_BATCH)
+    if not payments and not refunds:
+        return False
+
+    payment_objects = await fetch_all(payment_processor.get_payment,
+                                      [payment['id'] for payment in payments])
+    refund_objects = await fetch_all(payment_processor.get_refund,
+                                     [payment['refund_id'] for payment in refunds])
+
+    payment_updates, refund_updates, events = [], [], []
+    for payment, obj in zip(payments, payment_objects):
+        if obj is not None:
+            payment_updates.append((payment['id'], obj['status']))
+            events.append(bd.webhook_event(bd.PAYMENT_EVENTS, obj))
+    for payment, obj in zip(refunds, refund_objects):
+        if obj is not None:
+            refund_updates.append((payment['id'], obj['status']))
+            events.append(bd.webhook_event(bd.REFUND_EVENTS, obj))
+    events = [event for event in events if event is not None]
+
+    await bd_async.reconcile(payment_updates, refund_updates, events,
+                             datetime.now().isoformat())
+    logger.info(f"Reconciled {len(payment_updates)}/{len(payments)} payments, "
+                f"{len(refund_updates)}/{len(refunds)} refunds, "
+                f"{len(events)} missed webhooks replayed")
+    # полная пачка - вероятно, зависших строк больше; но если шлюз не ответил
+    # ни по одной, строки остались прежними и следующий проход повторил бы этот
+    full = RECONCILE_BATCH in (len(payments), len(refunds))
+    return full and bool(payment_updates or refund_updates)
+
+
+async def run():
+    payment_processor = yookassa_api.AsyncPaymentProcessor(
+        SHOP_ID, API_KEY, URL, max_rps=YOOKASSA_MAX_RPS or None,
+        max_concurrent=RECONCILE_CONCURRENCY)
+    try:
+        while True:
+            try:
+                more = await reconcile_once(payment_processor)
+            except Exception as e:
+                logger.error(f"Reconciliation error: {str(e)}")
+                more = False
+            if not more:
+                await asyncio.sleep(RECONCILE_INTERVAL)
+    finally:
+        await payment_processor.aclose()
+        bd_async.shutdown()
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Планировщик рекуррентных списаний - отдельный сервис.
+
+Запускается в нужном числе реплик на одной машине с базой (SQLite в режиме
+WAL работает через общую память и не поддерживает сетевые файловые системы):
+подписки делятся между ними арендой в bd.claim_due_subscriptions.
+YOOKASSA_MAX_RPS ограничивает частоту запросов одной реплики.
+Метрики отдаются на SCHEDULER_METRICS_PORT (0 - не отдавать).
+"""
+import logging
+import os
+import socket
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import yookassa_api
+from check_for_recurrent import check_recurrent_payments
+import metrics
+API_KEY = os.environ["API_KEY"]
+SHOP_ID = os.environ["SHOP_ID"]
+URL = os.environ["URL"]
+YOOKASSA_MAX_RPS = float(os.environ.get("YOOKASSA_MAX_RPS", 0))
+SCHEDULER_METRICS_PORT = int(os.environ.get("SCHEDULER_METRICS_PORT", 0))
+# имя реплики в subscriptions.claimed_by
+SCHEDULER_WORKER_ID = os.environ.get(
+    "SCHEDULER_WORKER_ID", f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}")
+
+logger = logging.getLogger(__name__)
+
+payment_processor = yookassa_api.PaymentProcessor(
+    SHOP_ID, API_KEY, URL, max_rps=YOOKASSA_MAX_RPS or None)
+
+update_gateway_metrics = yookassa_api.register_gateway_metrics(payment_processor, "recurrent")
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        update_gateway_metrics()
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_metrics(port: int):
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    if SCHEDULER_METRICS_PORT:
+        serve_metrics(SCHEDULER_METRICS_PORT)
+    logger.info(f"Recurrent payments scheduler {SCHEDULER_WORKER_ID} started")
+    check_recurrent_payments(payment_processor, SCHEDULER_WORKER_ID)
+
+
+if __name__ == "__main__":
+    main()
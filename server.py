@@ -1,24 +1,50 @@
 #!/usr/bin/env python3
 from pydantic import BaseModel
+from contextlib import asynccontextmanager
+import base64
 import datetime
+import json
+import secrets
 from typing import Dict, Optional
-from fastapi import FastAPI, HTTPException, status
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Header, HTTPException, Query, status
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 import yookassa_api
-from check_for_recurrent import start_recurrent_checker
 import bd
+import bd_async
+import metrics
+import tracing
 import os
 API_KEY = os.environ["API_KEY"]
 SHOP_ID = os.environ["SHOP_ID"]
 URL = os.environ["URL"]
+YOOKASSA_MAX_RPS = float(os.environ.get("YOOKASSA_MAX_RPS", 0))
+ORDERS_PAGE_MAX = 100
+# выгрузка /api/export доступна только с этим токеном; без него отключена
+EXPORT_TOKEN = os.environ.get("EXPORT_TOKEN")
+EXPORT_MEDIA_TYPES = {"csv": "text/csv; charset=utf-8", "jsonl": "application/x-ndjson"}
 
-payment_processor = yookassa_api.PaymentProcessor(SHOP_ID, API_KEY, URL)
+# рекуррентные списания выполняет отдельный сервис scheduler.py
+async_payment_processor = yookassa_api.AsyncPaymentProcessor(
+    SHOP_ID, API_KEY, URL, max_rps=YOOKASSA_MAX_RPS or None)
 
 
-app = FastAPI()
+update_gateway_metrics = yookassa_api.register_gateway_metrics(async_payment_processor, "api")
+DUE_SUBSCRIPTIONS = metrics.Gauge("recurrent_due_subscriptions",
+                                  "Subscriptions whose charge is due now")
 
 
-start_recurrent_checker(payment_processor)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    profiler = tracing.start_profiler()
+    yield
+    await async_payment_processor.aclose()
+    bd_async.shutdown()
+    tracing.stop_profiler(profiler)
+
+
+app = FastAPI(lifespan=lifespan)
+if tracing.TRACING:
+    app.middleware("http")(tracing.middleware)
 
 
 
@@ -44,16 +70,20 @@ def get_order_price(product: str) -> float:
 async def create_order(order_data: OrderCreate):
     price = get_order_price(order_data.product)
 
-    if not (order :=
-            payment_processor.create_payment(
-                amount=price,
-                currency='RUB',
-                description=f'product:{order_data.product}',
-                chat_id=order_data.chat_id)):
+    try:
+        order = await async_payment_processor.create_payment(
+            amount=price,
+            currency='RUB',
+            description=f'product:{order_data.product}',
+            chat_id=order_data.chat_id)
+    except yookassa_api.GatewayUnavailable:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Payment gateway unavailable")
+    if not order:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail="Payment failed")
 
-    bd.payments_insert(
+    await bd_async.payments_insert(
         id=order['id'],
         chat_id=order_data.chat_id,
         price=price,
@@ -62,42 +92,127 @@ async def create_order(order_data: OrderCreate):
         product=f"product:{order_data.product}",
         payment_method_id=None,
         is_recurrent=False,
-        created_at=datetime.datetime.now())
+        created_at=datetime.datetime.now().isoformat())
     return JSONResponse(content={"id": order['id'],
                                  "link": order['confirmation_url']},
                         status_code=status.HTTP_200_OK)
 
 
+def encode_cursor(order: dict) -> str:
+    return base64.urlsafe_b64encode(
+        json.dumps([order['created_at'], order['id']]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        created_at, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return created_at, id
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
 @app.get("/api/orders")
-async def get_orders(chat_id: int):
-    orders = bd.get_orders(search_name='chat_id', search_id=chat_id)
+async def get_orders(chat_id: int, status: Optional[str] = None,
+                     limit: int = Query(20, ge=1, le=ORDERS_PAGE_MAX),
+                     cursor: Optional[str] = None):
+    """Заказы от новых к старым; next_cursor передаётся в cursor для следующей страницы"""
+    orders = await bd_async.get_orders_page(
+        chat_id=chat_id, status=status, limit=limit + 1,
+        before=decode_cursor(cursor) if cursor else None)
+    next_cursor = encode_cursor(orders[limit - 1]) if len(orders) > limit else None
     res = []
-    for order in orders:
+    for order in orders[:limit]:
         res.append({"time": order['created_at'], "id": order['id'],
                     "product": order['description'].split(':', 1)[1],
                     'status': order['status']})
 
-    return JSONResponse(res)
+    return JSONResponse({"orders": res, "next_cursor": next_cursor})
 
 
 @app.post("/api/refund")
 async def refund_order(refund_data: OrderRefund):
 
-    order = bd.get_orders(search_name='id', search_id=refund_data.order_id)[0]
+    # статус могли только что изменить notify-bot или reconciler.py:
+    # их записи не сбрасывают кэш этого процесса
+    order = await bd_async.get_payment(refund_data.order_id, cached=False)
     if not order:
         print("Order not found")
         raise HTTPException(status_code=404, detail="Order not found")
     if str(order["chat_id"]) != str(refund_data.chat_id):
         print("Wrong chat_id???!!!")
         raise HTTPException(status_code=403, detail="Not your order")
-    if order["status"] != "succeeded":
+    if order["status"] != "succeeded" or order.get("refund_status") == "pending":
         print("status is smth but not succeeded")
         raise HTTPException(status_code=400, detail="Order not eligible for refund")
 
-    result = payment_processor.refund_payment(refund_data.order_id, order['amount'])
+    try:
+        result = await async_payment_processor.refund_payment(
+            refund_data.order_id, order['amount'])
+    except yookassa_api.GatewayUnavailable:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Payment gateway unavailable")
+    if not isinstance(result, dict):
+        # шлюз отказал в возврате
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Refund failed")
+    # до вебхука refund.succeeded возврат виден reconciler.py как ожидающий
+    await bd_async.update_refund_requested(
+        refund_data.order_id, result['id'], result['status'],
+        datetime.datetime.now().isoformat())
     # orders_db[refund_data.order_id]["status"] = "refunded"
     return result
 
+def parse_datetime(value: Optional[str], name: str) -> Optional[datetime.datetime]:
+    if value is None:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {name}")
+
+
+@app.get("/api/export/{table}")
+async def export(table: str, format: str = "csv", since: Optional[str] = None,
+                 until: Optional[str] = None, status: Optional[str] = None,
+                 chat_id: Optional[int] = None,
+                 x_export_token: Optional[str] = Header(None)):
+    """Выгрузка payments или subscriptions для бухгалтерии потоком CSV/JSONL.
+
+    since/until - границы по дате создания (until не включается), status -
+    статус платежа или состояние подписки. Строки отдаются по мере чтения
+    курсора, так что память не растёт с объёмом выгрузки."""
+    if not EXPORT_TOKEN or not secrets.compare_digest(
+            (x_export_token or "").encode(), EXPORT_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Export is not allowed")
+    if table not in bd.EXPORTS:
+        raise HTTPException(status_code=404, detail="Unknown table")
+    if format not in EXPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="Unknown format")
+    filename = f"{table}-{datetime.date.today().isoformat()}.{format}"
+    return StreamingResponse(
+        bd.export(table, format, parse_datetime(since, "since"),
+                  parse_datetime(until, "until"), status, chat_id),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+@app.get("/api/cache-stats")
+async def cache_stats():
+    return bd.row_cache.stats()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    update_gateway_metrics()
+    DUE_SUBSCRIPTIONS.set(
+        await bd_async.count_due_subscriptions(datetime.datetime.now().isoformat()))
+    return metrics.render()
+
+
+@app.get("/api/gateway-stats")
+async def gateway_stats():
+    return {"api": async_payment_processor.gateway_stats()}
+
 recurrent_payments_db: Dict[str, dict] = {}
 
 class RecurrentPaymentRequest(BaseModel):
@@ -116,7 +231,7 @@ async def create_recurrent_payment(request: RecurrentPaymentRequest):
         if request.interval < 1:
             raise ValueError("Интервал должен быть не менее 1")
 
-        order = payment_processor.create_payment(
+        order = await async_payment_processor.create_payment(
             request.amount,
             'RUB',
             f'product:{request.product}',
@@ -136,6 +251,10 @@ async def create_recurrent_payment(request: RecurrentPaymentRequest):
 
     except ValueError as ve:
         raise HTTPException(status_code=400, detail=str(ve))
+    except HTTPException:
+        raise
+    except yookassa_api.GatewayUnavailable:
+        raise HTTPException(status_code=503, detail="Платежный шлюз недоступен")
     except Exception as e:
         print(e)
         raise HTTPException(
@@ -1,5 +1,8 @@
 #!/usr/bin/env sh
 
+./bd.py
 ./telegram-bot.py &
+./scheduler.py &
+./reconciler.py &
 uvicorn server:app --port 5001 --reload &
 uvicorn notify-bot:app --port 5002 --reload
@@ -17,9 +17,22 @@ from telegram.ext import (
     CallbackContext,
     CallbackQueryHandler,
 )
-import requests
+import httpx
 import os
 SERVER_API_URL = os.environ["SERVER_API_URL"]
+SERVER_API_TIMEOUT = float(os.environ.get("SERVER_API_TIMEOUT", 30))
+# сколько апдейтов обрабатывается одновременно
+BOT_CONCURRENT_UPDATES = int(os.environ.get("BOT_CONCURRENT_UPDATES", 64))
+ORDERS_PAGE_SIZE = 5  # заказов на странице в "Мои заказы"
+REFUND_ORDERS_LIMIT = 20
+
+# Общий клиент с keep-alive соединениями к серверу, закрывается в post_shutdown
+http_client = httpx.AsyncClient(
+    base_url=SERVER_API_URL,
+    timeout=SERVER_API_TIMEOUT,
+    limits=httpx.Limits(max_connections=BOT_CONCURRENT_UPDATES,
+                        max_keepalive_connections=BOT_CONCURRENT_UPDATES),
+)
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -160,6 +173,10 @@ async def handle_callback(update: Update, context: CallbackContext) -> None:
     order_id = context.user_data.get('order_id', None)
     confirmation_type = context.user_data.get('confirmation-type', None)
     query = update.callback_query
+    if 'get' in option.__dir__() and option.get('type', None) == "orders":
+        # листание заказов редактирует то же сообщение, меню не отправляется;
+        # на callback отвечает show_orders_page
+        return await show_orders_page(query, chat_id, option['cursors'])
     await query.answer()
     if confirmation_type is not None:
         if confirmation_type == 'product' and option == "yes" and product is not None:
@@ -211,8 +228,8 @@ async def create_recurrent_payment(update: Update, context: CallbackContext, pro
         }
 
         # Вызов API для создания рекуррентного платежа
-        response = requests.post(
-            f"{SERVER_API_URL}/recurrent-payments",
+        response = await http_client.post(
+            "/recurrent-payments",
             json=payload
         )
         if response.status_code == 200:
@@ -230,14 +247,14 @@ async def create_recurrent_payment(update: Update, context: CallbackContext, pro
 
 async def create_order(update: Update, chat_id: int, product: str) -> bool:
     try:
-        response = requests.post(
-            f"{SERVER_API_URL}/create_order", json={"chat_id": chat_id, "product": product}
+        response = await http_client.post(
+            "/create_order", json={"chat_id": chat_id, "product": product}
         )
         
         if response.status_code == 200:
             return response.json()
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         await update.effective_user.send_message(f"Ошибка соединения с сервером {e}")
     return False
 
@@ -253,48 +270,81 @@ async def show_recurrent_products(update: Update, chat_id: int) -> bool:
 
 
 
+async def fetch_orders_page(chat_id: int, cursor: str = None) -> dict:
+    params = {"chat_id": chat_id, "limit": ORDERS_PAGE_SIZE}
+    if cursor:
+        params["cursor"] = cursor
+    response = await http_client.get("/orders", params=params)
+    response.raise_for_status()
+    return response.json()
+
+
+def render_orders_page(page: dict, cursors: list):
+    """Текст и клавиатура страницы заказов.
+    cursors - курсоры всех открытых страниц, последний - текущей (None - первая)"""
+    lines = ["Ваши заказы:"]
+    keyboard = []
+    for n, order in enumerate(page['orders'], start=1):
+        lines.append(
+            f"{n}. time: {order['time']}\nid: {order['id']}\nproduct: " +
+            f"{order['product']}\nstatus: {order['status']}"
+        )
+        row = [InlineKeyboardButton(
+            text=f"copy id {n}",
+            copy_text=CopyTextButton(order['id']))]
+        if order['status'] == "succeeded":
+            row.append(InlineKeyboardButton(
+                text=f"REFUND {n}",
+                callback_data={'type': "refund", 'order_id': order['id']}))
+        keyboard.append(row)
+    navigation = []
+    if len(cursors) > 1:
+        navigation.append(InlineKeyboardButton(
+            text="◀", callback_data={'type': "orders", 'cursors': cursors[:-1]}))
+    if page['next_cursor']:
+        navigation.append(InlineKeyboardButton(
+            text="▶", callback_data={'type': "orders",
+                                     'cursors': cursors + [page['next_cursor']]}))
+    if navigation:
+        keyboard.append(navigation)
+    return "\n\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+
 async def show_orders(update: Update, chat_id: int) -> bool:
     try:
-        response = requests.get(f"{SERVER_API_URL}/orders?chat_id={chat_id}")
-        if response.status_code != 200:
-            await update.effective_user.send_message(
-                "Заказов нет")
-            return False
-
-        orders = response.json()
-        if not orders:
+        page = await fetch_orders_page(chat_id)
+        if not page['orders']:
             await update.message.reply_text(
                 "Заказов нет")
             return False
 
-        await update.message.reply_text("Ваши заказы:")
-        for order in orders:
-            msg = (
-                f"time: {order['time']}\nid: {order['id']}:\nproduct: " +
-                f"{order['product']}\nstatus: {order['status']}"
-            )
-            button = [
-                [InlineKeyboardButton(
-                    text=f"copy id",
-                    copy_text=CopyTextButton(order['id']))],
-                [InlineKeyboardButton(
-                    text=f"REFUND",
-                    callback_data={'type': "refund", 'order_id': order['id']})]
-            ]
-            if order['status'] != "succeeded":
-                button.pop()
-            await update.message.reply_text(
-                msg, reply_markup=InlineKeyboardMarkup(button))
-    except requests.exceptions.RequestException as e:
+        text, markup = render_orders_page(page, [None])
+        await update.message.reply_text(text, reply_markup=markup)
+    except httpx.HTTPError as e:
         await update.message.reply_text(f"Ошибка получения заказов {e}")
     return False
 
 
+async def show_orders_page(query, chat_id: int, cursors: list) -> None:
+    """Листание заказов; на callback отвечает ровно один раз - Telegram
+    отклоняет повторный ответ"""
+    try:
+        page = await fetch_orders_page(chat_id, cursors[-1])
+    except httpx.HTTPError as e:
+        await query.answer(f"Ошибка получения заказов {e}")
+        return
+    await query.answer()
+    text, markup = render_orders_page(page, cursors)
+    await query.edit_message_text(text, reply_markup=markup)
+
+
 async def start_refund(update: Update, chat_id: int) -> bool:
     try:
-        response = requests.get(f"{SERVER_API_URL}/orders?chat_id={chat_id}")
+        response = await http_client.get(
+            "/orders", params={"chat_id": chat_id, "status": "succeeded",
+                               "limit": REFUND_ORDERS_LIMIT})
         if response.status_code == 200:
-            refundable = [o for o in response.json() if o["status"] == "succeeded"]
+            refundable = response.json()["orders"]
             if refundable:
                 keyboard = [[KeyboardButton(f"{o['id']}")] for o in refundable]
                 await update.message.reply_text(
@@ -304,30 +354,36 @@ async def start_refund(update: Update, chat_id: int) -> bool:
                 return True
             else:
                 await update.message.reply_text("Нет доступных заказов для возврата")
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         await update.message.reply_text(f"Ошибка получения заказов {e}")
     return False
 
 async def process_refund(update: Update, chat_id: int, order_id: str) -> bool:
     try:
-        response = requests.post(
-            f"{SERVER_API_URL}/refund", json={"chat_id": chat_id, "order_id": order_id}
+        response = await http_client.post(
+            "/refund", json={"chat_id": chat_id, "order_id": order_id}
         )
         if response.status_code == 200:
             await update.effective_user.send_message(f"Возврат для заказа {order_id} запущен")
             return True
         else:
             await update.effective_user.send_message(f"Ошибка возврата {response.json()['detail']}")
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         await update.effective_user.send_message(f"Ошибка соединения с сервером {e}")
     return False
 
 
+async def close_http_client(application: Application) -> None:
+    await http_client.aclose()
+
+
 def main() -> None:
     application = (
         Application.builder()
         .token("7567195140:AAHAFnyTM9V5s7A5sQYiOcv5B_GLl1CF-HQ")
         .arbitrary_callback_data(True)
+        .concurrent_updates(BOT_CONCURRENT_UPDATES)
+        .post_shutdown(close_http_client)
         .build()
     )
     application.add_handler(
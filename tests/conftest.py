@@ -0,0 +1,19 @@
+"""Общие фикстуры: bd.py на временной базе SQLite"""
+import os
+
+import pytest
+
+os.environ.setdefault("DATABASE_NAME", ":memory:")
+
+import bd
+from cache import TTLCache
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(bd, "DATABASE_NAME", str(tmp_path / "test.db"))
+    monkeypatch.setattr(bd, "_local", bd.threading.local())
+    monkeypatch.setattr(bd, "row_cache", TTLCache(100, 60))
+    bd.migrate()
+    yield bd.get_connection()
+    bd.get_connection().close()
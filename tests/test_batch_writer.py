@@ -0,0 +1,73 @@
+"""Групповая запись bd.BatchWriter: одна транзакция на пачку, откат на
+построчную запись при ошибке и ожидание коммита через deferred_writes.
+
+Запуск из корня репозитория: python -m pytest tests
+"""
+import sqlite3
+
+import pytest
+
+import bd
+
+INSERT = '''
+    INSERT INTO notification_outbox (id, chat_id, text, status, attempts, created_at)
+    VALUES (?, '1', ?, 'new', 0, '2026-01-01T00:00:00')
+'''
+
+
+@pytest.fixture
+def writer(db):
+    writer = bd.BatchWriter(max_rows=100, max_delay=0.2)
+    yield writer
+    writer.close()
+
+
+def texts(db) -> dict:
+    return dict(db.execute('SELECT id, text FROM notification_outbox'))
+
+
+def batch_commits() -> int:
+    series = bd.DB_LATENCY.series.get((('query', 'batch_commit'),))
+    return series[2] if series else 0
+
+
+def test_batch_is_one_transaction(db, writer):
+    before = batch_commits()
+    futures = [writer.submit(INSERT, (id, f"text {id}")) for id in range(1, 6)]
+    for future in futures:
+        assert future.result(timeout=5) is None
+    assert batch_commits() == before + 1
+    assert texts(db) == {id: f"text {id}" for id in range(1, 6)}
+
+
+def test_failing_row_does_not_fail_neighbours(db, writer):
+    db.execute(INSERT, (2, "existing"))
+    db.commit()
+    futures = [writer.submit(INSERT, (id, f"text {id}")) for id in (1, 2, 3)]
+    assert futures[0].result(timeout=5) is None
+    with pytest.raises(sqlite3.IntegrityError):
+        futures[1].result(timeout=5)
+    assert futures[2].result(timeout=5) is None
+    assert texts(db) == {1: "text 1", 2: "existing", 3: "text 3"}
+
+
+def test_commit_invalidates_cache(db, writer):
+    bd.row_cache.get_or_load(('notification_outbox', 1), lambda: "stale")
+    writer.submit(INSERT, (1, "fresh"), ('notification_outbox', 1)).result(timeout=5)
+    assert bd.row_cache.get_or_load(('notification_outbox', 1), lambda: "loaded") == "loaded"
+
+
+def test_close_flushes_queue(db):
+    writer = bd.BatchWriter(max_rows=100, max_delay=10)
+    future = writer.submit(INSERT, (1, "text"))
+    writer.close()
+    assert future.done() and texts(db) == {1: "text"}
+
+
+def test_deferred_writes_collect_futures(db, writer, monkeypatch):
+    monkeypatch.setattr(bd, "batch_writer", writer)
+    with bd.deferred_writes() as futures:
+        bd.outbox_insert("1", "text", None, "2026-01-01T00:00:00")
+    assert len(futures) == 1
+    futures[0].result(timeout=5)
+    assert list(texts(db).values()) == ["text"]
@@ -0,0 +1,111 @@
+"""Переходы размыкателя: closed -> open -> half_open -> closed/open и лимит проб.
+
+Запуск из корня репозитория: python -m pytest tests
+"""
+import pytest
+
+import circuit_breaker
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Подменяет time.monotonic размыкателя; clock.now двигают тесты"""
+    class Clock:
+        now = 1000.0
+
+        def monotonic(self):
+            return self.now
+
+    clock = Clock()
+    monkeypatch.setattr(circuit_breaker.time, "monotonic", clock.monotonic)
+    return clock
+
+
+def opened(clock, **kwargs) -> CircuitBreaker:
+    breaker = CircuitBreaker(window=4, min_calls=4, failure_rate=0.5,
+                             open_timeout=30, **kwargs)
+    for _ in range(4):
+        breaker.record_failure()
+    assert breaker.state == OPEN
+    return breaker
+
+
+def test_stays_closed_below_min_calls(clock):
+    breaker = CircuitBreaker(window=4, min_calls=4, failure_rate=0.5)
+    for _ in range(3):
+        breaker.record_failure()
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+
+
+def test_stays_closed_below_failure_rate(clock):
+    breaker = CircuitBreaker(window=4, min_calls=4, failure_rate=0.5)
+    for ok in (True, True, True, False, True):
+        breaker.record_success() if ok else breaker.record_failure()
+    assert breaker.state == CLOSED
+
+
+def test_opens_at_failure_rate(clock):
+    breaker = CircuitBreaker(window=4, min_calls=4, failure_rate=0.5)
+    for ok in (True, False, True, False):
+        breaker.record_success() if ok else breaker.record_failure()
+    assert breaker.state == OPEN
+
+
+def test_open_rejects_until_timeout(clock):
+    breaker = opened(clock)
+    assert not breaker.allow()
+    assert breaker.retry_in() == 30
+    clock.now += 29
+    assert not breaker.allow()
+    assert breaker.stats()["rejected"] == 2
+
+
+def test_half_open_after_timeout(clock):
+    breaker = opened(clock)
+    clock.now += 30
+    assert breaker.retry_in() == 0
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+
+
+def test_successful_probe_closes(clock):
+    breaker = opened(clock)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.stats()["window_calls"] == 1
+    assert breaker.allow()
+
+
+def test_failed_probe_reopens(clock):
+    breaker = opened(clock)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert breaker.retry_in() == 30
+
+
+def test_probe_limit(clock):
+    breaker = opened(clock, half_open_calls=2)
+    clock.now += 30
+    assert breaker.allow()
+    assert breaker.allow()
+    assert not breaker.allow()
+    assert breaker.retry_in() == 30
+
+
+def test_probe_that_never_reports_expires(clock):
+    breaker = opened(clock)
+    clock.now += 30
+    assert breaker.allow()
+    clock.now += 29
+    assert not breaker.allow()
+    clock.now += 1
+    # первая проба так и не вызвала record_*: её слот освобождается
+    assert breaker.allow()
+    assert not breaker.allow()
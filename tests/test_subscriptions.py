@@ -0,0 +1,220 @@
+"""Очередь рекуррентных списаний в bd.py на временной базе SQLite.
+
+Запуск из корня репозитория: python -m pytest tests
+"""
+from datetime import datetime, timedelta
+
+import bd
+
+T0 = "2026-01-01T00:00:00"
+DAY = 86400
+
+
+def at(seconds: float) -> str:
+    """Момент через seconds секунд после T0"""
+    return (datetime.fromisoformat(T0) + timedelta(seconds=seconds)).isoformat()
+
+
+def subscribe(payment_id: str, last_payment: str = T0, interval: int = DAY):
+    bd.subscriptions_insert(payment_id, "1", True, last_payment, None, last_payment,
+                            interval, 100.0, "RUB", "product")
+
+
+def claim(now: str, worker: str = "w1", limit: int = 10, retries: bool = False,
+          lease: float = 300) -> list:
+    lease_expires = (datetime.fromisoformat(now) + timedelta(seconds=lease)).isoformat()
+    claimed = bd.claim_due_subscriptions(worker, now, lease_expires, limit, retries)
+    return [sub['payment_method_id'] for sub in claimed]
+
+
+def state(payment_id: str) -> str:
+    return bd.get_subscription(payment_id)['state']
+
+
+def test_deferred_charge_keeps_due_time(db):
+    subscribe("old", at(-DAY))
+    assert claim(at(DAY)) == ["old"]
+    bd.reschedule_subscription("old", at(DAY + 60))
+    sub = bd.get_subscription("old")
+    assert sub['state'] == 'active'
+    assert sub['next_due_at'] == at(0)
+    assert bd.get_next_due_at() == at(DAY + 60)
+
+
+def test_deferred_charge_waits_for_retry_after(db):
+    subscribe("old", at(-DAY))
+    claim(at(DAY))
+    bd.reschedule_subscription("old", at(DAY + 60))
+    assert claim(at(DAY + 30)) == []
+    assert claim(at(DAY + 60)) == ["old"]
+    assert bd.get_subscription("old")['retry_after'] is None
+
+
+def defer_pending_charge():
+    """awaiting_webhook -> charging (перепроверка) -> отложена из-за шлюза"""
+    subscribe("sub")
+    claim(at(DAY))
+    bd.await_subscription_webhook("sub", at(DAY + 3600), "charge", worker="w1")
+    assert claim(at(DAY + 3600)) == ["sub"]
+    bd.reschedule_subscription("sub", at(DAY + 3660), worker="w1")
+    sub = bd.get_subscription("sub")
+    assert (sub['state'], sub['charge_id']) == ('awaiting_webhook', "charge")
+
+
+def test_deferred_recheck_accepts_webhook_success(db):
+    defer_pending_charge()
+    bd.update_subscription_success(at(DAY + 3620), "sub")
+    sub = bd.get_subscription("sub")
+    assert (sub['state'], sub['last_payment'], sub['charge_id']) == ('active', at(DAY + 3620), None)
+
+
+def test_deferred_recheck_accepts_webhook_cancel(db):
+    defer_pending_charge()
+    bd.update_subscription_error(at(DAY + 3620), "sub", at(DAY + 7200), error="canceled")
+    sub = bd.get_subscription("sub")
+    assert (sub['state'], sub['failures'], sub['charge_id']) == ('retry_scheduled', 1, None)
+
+
+def test_deferred_retry_stays_a_retry(db):
+    subscribe("sub")
+    claim(at(DAY))
+    bd.update_subscription_error(at(DAY), "sub", at(DAY + 60), worker="w1")
+    claim(at(DAY + 60), retries=True)
+    bd.reschedule_subscription("sub", at(DAY + 120), worker="w1")
+    assert state("sub") == 'retry_scheduled'
+
+
+def test_deferred_charge_stays_most_overdue(db):
+    subscribe("old", at(-DAY))
+    claim(at(DAY))
+    bd.reschedule_subscription("old", at(DAY + 60))
+    subscribe("new", at(30))
+    assert claim(at(DAY + 60), limit=1) == ["old"]
+
+
+def test_success_starts_next_period(db):
+    subscribe("sub")
+    claim(at(DAY))
+    bd.update_subscription_success(at(DAY + 1), "sub", worker="w1")
+    sub = bd.get_subscription("sub")
+    assert sub['state'] == 'active'
+    assert sub['last_payment'] == at(DAY + 1)
+    assert datetime.fromisoformat(sub['next_due_at']) == datetime.fromisoformat(at(2 * DAY + 1))
+    assert sub['claimed_by'] is None and sub['lease_expires'] is None
+
+
+def test_error_schedules_retry_then_suspends(db):
+    subscribe("sub")
+    for attempt in range(1, 3):
+        assert claim(at(attempt * DAY), retries=attempt > 1) == ["sub"]
+        bd.update_subscription_error(at(attempt * DAY), "sub", at((attempt + 1) * DAY),
+                                     error="declined", max_failures=2, worker="w1")
+        sub = bd.get_subscription("sub")
+        assert sub['failures'] == attempt
+        assert sub['last_error'] == "declined"
+    assert sub['state'] == 'suspended'
+    assert claim(at(10 * DAY)) == [] and claim(at(10 * DAY), retries=True) == []
+
+
+def test_retries_are_a_separate_queue(db):
+    subscribe("sub")
+    claim(at(DAY))
+    bd.update_subscription_error(at(DAY), "sub", at(DAY + 60), worker="w1")
+    assert state("sub") == 'retry_scheduled'
+    assert claim(at(DAY + 60)) == []
+    assert claim(at(DAY + 60), retries=True) == ["sub"]
+
+
+def test_webhook_completes_pending_charge(db):
+    subscribe("sub")
+    claim(at(DAY))
+    bd.await_subscription_webhook("sub", at(DAY + 3600), "charge", worker="w1")
+    sub = bd.get_subscription("sub")
+    assert sub['state'] == 'awaiting_webhook' and sub['charge_id'] == "charge"
+    assert claim(at(DAY + 60)) == []
+    bd.update_subscription_success(at(DAY + 60), "sub")
+    sub = bd.get_subscription("sub")
+    assert sub['state'] == 'active' and sub['charge_id'] is None
+
+
+def test_lost_webhook_is_rechecked(db):
+    subscribe("sub")
+    claim(at(DAY))
+    bd.await_subscription_webhook("sub", at(DAY + 3600), "charge", worker="w1")
+    claimed = bd.claim_due_subscriptions("w1", at(DAY + 3600), at(DAY + 3900), 10)
+    assert [(sub['state'], sub['charge_id']) for sub in claimed] == [('charging', "charge")]
+
+
+def test_transition_from_wrong_state_is_ignored(db):
+    subscribe("sub")
+    claim(at(DAY))
+    bd.update_subscription_success(at(DAY + 1), "sub")
+    # ответ шлюза пришёл после вебхука: подписка уже active
+    bd.await_subscription_webhook("sub", at(DAY + 3600), "charge", worker="w1")
+    bd.update_subscription_error(at(DAY + 1), "sub", at(DAY + 60), worker="w1")
+    sub = bd.get_subscription("sub")
+    assert sub['state'] == 'active' and sub['failures'] == 0
+
+
+def test_expired_lease_is_reclaimed(db):
+    subscribe("sub")
+    assert claim(at(DAY), worker="w1", lease=300) == ["sub"]
+    assert claim(at(DAY + 299), worker="w2") == []
+    assert claim(at(DAY + 300), worker="w2") == ["sub"]
+    assert bd.get_subscription("sub")['claimed_by'] == "w2"
+
+
+def test_claim_invalidates_cached_subscription(db):
+    subscribe("sub")
+    assert state("sub") == 'active'
+    claim(at(DAY))
+    assert state("sub") == 'charging'
+
+
+def test_stale_worker_leaves_new_owner_alone(db):
+    subscribe("sub")
+    claim(at(DAY), worker="w1", lease=300)
+    claim(at(DAY + 300), worker="w2")
+    bd.update_subscription_error(at(DAY + 301), "sub", at(DAY + 360), worker="w1")
+    bd.await_subscription_webhook("sub", at(DAY + 3600), "charge", worker="w1")
+    bd.reschedule_subscription("sub", at(DAY + 360), worker="w1")
+    bd.update_subscription_success(at(DAY + 301), "sub", worker="w1")
+    sub = bd.get_subscription("sub")
+    assert (sub['state'], sub['claimed_by'], sub['failures']) == ('charging', "w2", 0)
+    bd.update_subscription_success(at(DAY + 302), "sub", worker="w2")
+    assert state("sub") == 'active'
+
+
+def test_migration_backfills_due_time_and_state(db, tmp_path):
+    conn = bd.sqlite3.connect(tmp_path / "old.db")
+    conn.executescript(f"{bd.MIGRATIONS[0]}\n{bd.MIGRATIONS[1]}\nPRAGMA user_version = 2;")
+    conn.executemany('''
+        INSERT INTO subscriptions (payment_method_id, saved, last_payment,
+            last_error_message, interval)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [("ok", True, T0, None, DAY),
+          ("failed", True, T0, at(DAY), DAY),
+          ("unsaved", False, T0, None, DAY)])
+    conn.commit()
+    bd.migrate(conn)
+    conn.row_factory = bd.dict_factory
+    rows = {row['payment_method_id']: row for row in conn.execute('SELECT * FROM subscriptions')}
+    indexes = {row['name'] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'subscriptions'")}
+    conn.close()
+    assert not indexes & {'subscriptions_active', 'subscriptions_failed'}
+    assert {id: (row['state'], row['failures']) for id, row in rows.items()} == {
+        "ok": ('active', 0), "failed": ('retry_scheduled', 1), "unsaved": ('suspended', 0)}
+    for row in rows.values():
+        assert datetime.fromisoformat(row['next_due_at']) == datetime.fromisoformat(at(DAY))
+
+
+def test_replayed_charge_webhook_is_not_processed_twice(db):
+    order = {"id": "charge", "status": "succeeded", "amount": {"value": "100.00"},
+             "payment_method": {"id": "sub", "saved": True}}
+    event = bd.webhook_event(bd.PAYMENT_EVENTS, order)
+    bd.inbox_replay([event], at(DAY))
+    bd.inbox_replay([event], at(DAY + 1))
+    assert db.execute('SELECT COUNT(*) FROM webhook_inbox').fetchone()[0] == 1
+    # настоящий вебхук о том же платеже - повтор
+    assert not bd.inbox_insert(event[0], event[1], event[2], at(DAY + 2))
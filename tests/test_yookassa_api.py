@@ -0,0 +1,123 @@
+"""Классификация ошибок шлюза на исключениях, которые поднимает сам yookassa SDK.
+
+Запуск из корня репозитория: python -m pytest tests
+"""
+import asyncio
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("yookassa")
+pytest.importorskip("httpx")
+
+from yookassa import Configuration, Payment
+from yookassa.domain.exceptions.api_error import ApiError
+from yookassa.domain.exceptions.bad_request_error import BadRequestError
+from yookassa.domain.exceptions.not_found_error import NotFoundError
+from yookassa.domain.exceptions.response_processing_error import ResponseProcessingError
+from yookassa.domain.exceptions.too_many_request_error import TooManyRequestsError
+
+import yookassa_api
+
+
+@pytest.fixture
+def gateway():
+    """Локальный шлюз, отвечающий на любой запрос кодом gateway.code"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = b'{"type": "error", "code": "error", "description": "test"}'
+            self.send_response(server.code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.code = 503
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    Configuration.configure("shop", "key")
+    Configuration.api_url = f"http://127.0.0.1:{server.server_address[1]}/v3"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def sdk_error() -> Exception:
+    with pytest.raises(Exception) as raised:
+        Payment.find_one("payment-id")
+    return raised.value
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.mark.parametrize("code", [500, 502, 503, 504])
+def test_sdk_5xx_is_transient(gateway, code):
+    gateway.code = code
+    assert yookassa_api.is_transient(sdk_error())
+
+
+@pytest.mark.parametrize("code", [400, 401, 403, 404])
+def test_sdk_4xx_is_not_transient(gateway, code):
+    gateway.code = code
+    assert not yookassa_api.is_transient(sdk_error())
+
+
+def test_sdk_connection_refused_is_transient():
+    Configuration.configure("shop", "key")
+    Configuration.api_url = f"http://127.0.0.1:{free_port()}/v3"
+    assert yookassa_api.is_transient(sdk_error())
+
+
+@pytest.mark.parametrize("error, transient", [
+    (ApiError("internal"), True),
+    (ResponseProcessingError({}), True),
+    (TooManyRequestsError({}), True),
+    (BadRequestError({}), False),
+    (NotFoundError({}), False),
+    (ValueError("bad payload"), False),
+])
+def test_sdk_exception_instances(error, transient):
+    assert yookassa_api.is_transient(error) == transient
+
+
+def test_sdk_outage_counts_as_breaker_failure(gateway):
+    processor = yookassa_api.PaymentProcessor("shop", "key", "http://localhost",
+                                              retries=2, backoff_base=0)
+    Configuration.api_url = f"http://127.0.0.1:{gateway.server_address[1]}/v3"
+    with pytest.raises(yookassa_api.GatewayUnavailable):
+        processor.with_retries("payments", lambda: Payment.find_one("payment-id"))
+    assert processor.circuit_breaker.stats()["window_failures"] == 3
+
+
+def test_sdk_refusal_counts_as_breaker_success(gateway):
+    gateway.code = 404
+    processor = yookassa_api.PaymentProcessor("shop", "key", "http://localhost",
+                                              retries=2, backoff_base=0)
+    Configuration.api_url = f"http://127.0.0.1:{gateway.server_address[1]}/v3"
+    with pytest.raises(NotFoundError):
+        processor.with_retries("payments", lambda: Payment.find_one("payment-id"))
+    assert processor.circuit_breaker.stats()["window_failures"] == 0
+
+
+def test_async_bulkhead_timeout_keeps_permits():
+    async def scenario():
+        processor = yookassa_api.AsyncPaymentProcessor(
+            "shop", "key", "http://localhost", max_concurrent=1, bulkhead_timeout=0.01)
+        await processor.bulkheads["payments"].acquire()
+        for _ in range(20):
+            with pytest.raises(yookassa_api.GatewayBusy):
+                await processor._send("payments", None)
+        processor.bulkheads["payments"].release()
+        await processor.aclose()
+        return processor.bulkheads["payments"]._value
+
+    assert asyncio.run(scenario()) == 1
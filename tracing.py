@@ -0,0 +1,156 @@
+"""Опциональная трассировка запросов без внешнего коллектора.
+
+TRACING=1 включает трассировку, TRACING_SAMPLE_RATE - долю трассируемых
+запросов. Span'ы собираются в trace текущего контекста (contextvars), поэтому
+видны через await и через потоки bd_async. Итог пишется одной JSON строкой в
+лог и, для HTTP запросов, в заголовок Server-Timing.
+
+TRACING_PROFILE=путь включает сэмплирующий профайлер: раз в
+TRACING_PROFILE_INTERVAL секунд снимаются стеки всех потоков, при остановке
+они сохраняются в формате collapsed stacks (для flamegraph.pl/speedscope).
+"""
+import contextvars
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+TRACING = os.environ.get("TRACING", "0") == "1"
+TRACING_SAMPLE_RATE = float(os.environ.get("TRACING_SAMPLE_RATE", 1))
+TRACING_PROFILE = os.environ.get("TRACING_PROFILE")
+TRACING_PROFILE_INTERVAL = float(os.environ.get("TRACING_PROFILE_INTERVAL", 0.005))
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar("trace", default=None)
+
+
+class Trace:
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.spans = []  # (name, seconds); list.append потокобезопасен
+
+    def summary(self) -> dict:
+        """Суммарное время и число вызовов по имени span'а"""
+        totals = {}
+        for name, seconds in self.spans:
+            total, count = totals.get(name, (0.0, 0))
+            totals[name] = (total + seconds, count + 1)
+        return totals
+
+    def server_timing(self, total: float) -> str:
+        parts = [f"{name};desc=\"x{count}\";dur={seconds * 1000:.2f}"
+                 for name, (seconds, count) in self.summary().items()]
+        parts.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(parts)
+
+    def log(self, total: float, **extra):
+        logger.info(json.dumps({
+            "trace": self.name,
+            "duration_ms": round(total * 1000, 3),
+            "spans": {name: {"ms": round(seconds * 1000, 3), "count": count}
+                      for name, (seconds, count) in self.summary().items()},
+            **extra,
+        }, ensure_ascii=False))
+
+
+@contextmanager
+def trace(name: str):
+    """Открывает trace, если трассировка включена и запрос попал в выборку"""
+    if not TRACING or random.random() >= TRACING_SAMPLE_RATE:
+        yield None
+        return
+    current = Trace(name)
+    token = _current.set(current)
+    try:
+        yield current
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def span(name: str):
+    current = _current.get()
+    if current is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        current.spans.append((name, time.perf_counter() - start))
+
+
+@contextmanager
+def background(name: str):
+    """trace для фоновой работы вне HTTP запроса: итог только в лог"""
+    with trace(name) as current:
+        yield current
+        if current is not None:
+            current.log(time.perf_counter() - current.start)
+
+
+async def middleware(request, call_next):
+    """HTTP middleware для FastAPI; подключается только при TRACING=1,
+    чтобы без трассировки запросы не проходили через BaseHTTPMiddleware"""
+    with trace(f"{request.method} {request.url.path}") as current:
+        response = await call_next(request)
+        if current is not None:
+            total = time.perf_counter() - current.start
+            response.headers["Server-Timing"] = current.server_timing(total)
+            current.log(total, status=response.status_code)
+        return response
+
+
+class SamplingProfiler:
+    def __init__(self, path: str, interval: float):
+        self.path = path
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="sampling-profiler",
+                                       daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        with open(self.path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        logger.info(f"Profile with {sum(self.stacks.values())} samples written to {self.path}")
+
+
+def start_profiler():
+    """Запускает профайлер, если задан TRACING_PROFILE; вернуть его в stop_profiler"""
+    if not TRACING_PROFILE:
+        return None
+    profiler = SamplingProfiler(TRACING_PROFILE, TRACING_PROFILE_INTERVAL)
+    profiler.start()
+    return profiler
+
+
+def stop_profiler(profiler):
+    if profiler is not None:
+        profiler.stop()
@@ -1,18 +1,173 @@
 import yookassa
 from yookassa import Configuration, Payment, Refund, Webhook
+from yookassa.domain.exceptions.api_error import ApiError
+import asyncio
+import httpx
+import random
+import requests
+import threading
+import time
 import uuid
 import logging
+import os
+from rate_limiter import RateLimiter
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+import metrics
+import tracing
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# переопределяется для нагрузочных тестов с локальной заглушкой шлюза
+YOOKASSA_API_URL = os.environ.get("YOOKASSA_API_URL", "https://api.yookassa.ru/v3")
+# HTTP коды YooKassa, после которых запрос с тем же ключом идемпотентности можно повторить
+TRANSIENT_HTTP_CODES = (202, 429, 500, 502, 503, 504)
+
+
+OPERATIONS = ("payments", "refunds")
+
+GATEWAY_LATENCY = metrics.Histogram(
+    "gateway_request_duration_seconds", "Duration of YooKassa API requests")
+
+
+BREAKER_STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+GATEWAY_CIRCUIT_STATE = metrics.Gauge(
+    "gateway_circuit_state", "Circuit breaker state: 0 closed, 1 half-open, 2 open")
+GATEWAY_IN_FLIGHT = metrics.Gauge("gateway_in_flight_requests", "In-flight YooKassa requests")
+
+
+def register_gateway_metrics(processor, name: str):
+    """Возвращает функцию, которую вызывают перед metrics.render(), чтобы
+    обновить состояние размыкателя и число запросов в полёте processor
+    (с меткой processor=name)"""
+    def update():
+        GATEWAY_CIRCUIT_STATE.set(BREAKER_STATES[processor.circuit_breaker.state],
+                                  processor=name)
+        for operation, count in processor.in_flight_snapshot().items():
+            GATEWAY_IN_FLIGHT.set(count, processor=name, operation=operation)
+    return update
+
+
+class GatewayUnavailable(Exception):
+    """Шлюз не ответил после всех повторов; результат запроса неизвестен"""
+
+
+class CircuitOpen(GatewayUnavailable):
+    """Запрос не отправлялся: шлюз считается недоступным"""
+
+
+class GatewayBusy(GatewayUnavailable):
+    """Запрос не отправлялся: заняты все слоты операции"""
+
+
+def is_transient(e: BaseException) -> bool:
+    """Можно ли повторить запрос с тем же ключом идемпотентности: шлюз не
+    ответил или ответил временной ошибкой"""
+    if isinstance(e, httpx.TransportError):
+        return True
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in TRANSIENT_HTTP_CODES
+    if isinstance(e, requests.RequestException):
+        return (e.response is None or e.response.status_code in TRANSIENT_HTTP_CODES
+                or e.response.status_code >= 500)
+    if isinstance(e, ApiError):
+        # SDK знает только коды 4xx и 202: на остальные, в т.ч. 5xx, он
+        # поднимает ApiError с HTTP_CODE = 0
+        return e.HTTP_CODE in TRANSIENT_HTTP_CODES or e.HTTP_CODE == 0
+    # ошибку транспорта SDK перехватывает и разбирает её пустой response,
+    # так что наружу выходит AttributeError, а исходная ошибка - в __context__
+    context = e.__cause__ or e.__context__
+    return context is not None and is_transient(context)
+
+
 class PaymentProcessor:
-    def __init__(self, shop_id: str, api_key: str, base_url: str):
+    def __init__(self, shop_id: str, api_key: str, base_url: str,
+                 max_rps: float = None, rate_limiter: RateLimiter = None,
+                 retries: int = 3, backoff_base: float = 0.5, backoff_max: float = 10,
+                 circuit_breaker: CircuitBreaker = None,
+                 max_concurrent: int = 50, bulkhead_timeout: float = 5):
+        """max_rps - ограничение запросов к шлюзу в секунду (общее для всех потоков),
+        rate_limiter - готовый ограничитель, если он общий с другим процессором,
+        retries - повторы при временных ошибках с тем же ключом идемпотентности,
+        circuit_breaker - общий размыкатель (по умолчанию свой),
+        max_concurrent - одновременных запросов на каждую операцию (платежи, возвраты),
+        bulkhead_timeout - сколько ждать свободный слот до GatewayBusy"""
         Configuration.configure(shop_id, api_key)
+        Configuration.api_url = YOOKASSA_API_URL
         self.base_url = base_url
+        self.rate_limiter = rate_limiter or (RateLimiter(max_rps) if max_rps else None)
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.max_concurrent = max_concurrent
+        self.bulkhead_timeout = bulkhead_timeout
+        self.bulkheads = {op: threading.BoundedSemaphore(max_concurrent) for op in OPERATIONS}
+        self.in_flight = dict.fromkeys(OPERATIONS, 0)
+        # in_flight меняют одновременно потоки RECURRENT_PAYMENT_WORKERS
+        self.in_flight_lock = threading.Lock()
         # self.setup_webhooks()
 
+    def gateway_stats(self) -> dict:
+        return {"circuit_breaker": self.circuit_breaker.stats(),
+                "in_flight": self.in_flight_snapshot(),
+                "max_concurrent": self.max_concurrent}
+
+    def track_in_flight(self, operation: str, delta: int):
+        with self.in_flight_lock:
+            self.in_flight[operation] += delta
+
+    def in_flight_snapshot(self) -> dict:
+        with self.in_flight_lock:
+            return dict(self.in_flight)
+
+    def backoff(self, attempt: int) -> float:
+        """Экспоненциальная задержка с полным джиттером"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def check_transient(self, e: Exception, attempt: int) -> float:
+        """Учитывает ошибку в размыкателе; возвращает задержку перед повтором
+        или пробрасывает исключение, если повторять нельзя"""
+        if not is_transient(e):
+            # шлюз ответил, хоть и отказом - для размыкателя это успех
+            self.circuit_breaker.record_success()
+            raise e
+        self.circuit_breaker.record_failure()
+        if attempt == self.retries:
+            raise GatewayUnavailable(str(e)) from e
+        delay = self.backoff(attempt)
+        logger.warning(f"Transient gateway error, retry in {delay:.2f}s: {str(e)}")
+        return delay
+
+    def with_retries(self, operation: str, request):
+        if not self.bulkheads[operation].acquire(timeout=self.bulkhead_timeout):
+            raise GatewayBusy(f"Too many concurrent {operation} requests")
+        self.track_in_flight(operation, 1)
+        try:
+            for attempt in range(self.retries + 1):
+                if not self.circuit_breaker.allow():
+                    raise CircuitOpen("Payment gateway circuit is open")
+                if self.rate_limiter:
+                    with tracing.span("gateway.rate_limit"):
+                        self.rate_limiter.acquire()
+                start = time.perf_counter()
+                try:
+                    with tracing.span(f"gateway.{operation}"):
+                        result = request()
+                except Exception as e:
+                    GATEWAY_LATENCY.observe(time.perf_counter() - start,
+                                            operation=operation, outcome="error")
+                    time.sleep(self.check_transient(e, attempt))
+                    continue
+                GATEWAY_LATENCY.observe(time.perf_counter() - start,
+                                        operation=operation, outcome="ok")
+                self.circuit_breaker.record_success()
+                return result
+        finally:
+            self.track_in_flight(operation, -1)
+            self.bulkheads[operation].release()
+
     def setup_webhooks(self):
         """Configure required webhooks for payment notifications"""
         webhook_events = [
@@ -28,19 +183,17 @@ class PaymentProcessor:
             except Exception as e:
                 logger.error(f"Failed to configure webhook: {str(e)}")
 
-    def create_payment(
+    def payment_payload(
             self,
             amount: float,
             currency: str,
             description: str,
             chat_id: str,
             start_recurrent: bool = False,
-            payment_method_id: str = None, # after recurrent this is saved
+            payment_method_id: str = None,
             return_url: str = None,
             metadata=None,
-    ):
-        """Create payment with optional recurrent setup"""
-        idempotence_key = str(uuid.uuid4())
+    ) -> dict:
         payload = {
             "amount": {
                 "value": f"{amount:.2f}",
@@ -63,9 +216,40 @@ class PaymentProcessor:
         if payment_method_id:
             payload["payment_method_id"] = payment_method_id
             payload.pop("confirmation")
+        return payload
+
+    @staticmethod
+    def refund_payload(payment_id: str, amount: float, currency: str) -> dict:
+        return {
+            "payment_id": payment_id,
+            "amount": {
+                "value": f"{amount:.2f}",
+                "currency": currency
+            }
+        }
+
+    def create_payment(
+            self,
+            amount: float,
+            currency: str,
+            description: str,
+            chat_id: str,
+            start_recurrent: bool = False,
+            payment_method_id: str = None, # after recurrent this is saved
+            return_url: str = None,
+            metadata=None,
+            idempotence_key: str = None,
+    ):
+        """Create payment with optional recurrent setup.
+        Raises GatewayUnavailable if the gateway kept failing transiently."""
+        idempotence_key = idempotence_key or str(uuid.uuid4())
+        payload = self.payment_payload(
+            amount, currency, description, chat_id, start_recurrent,
+            payment_method_id, return_url, metadata)
 
         try:
-            payment = Payment.create(payload, idempotence_key)
+            payment = self.with_retries(
+                "payments", lambda: Payment.create(payload, idempotence_key))
             logger.info(f"Created payment {payment.json()}")
             return {
                 "id": payment.id,
@@ -73,6 +257,9 @@ class PaymentProcessor:
                 "confirmation_url": payment.confirmation.confirmation_url if not payment_method_id else None,
                 "payment_method_id": payment.payment_method.id if payment.payment_method else None
             }
+        except GatewayUnavailable as e:
+            logger.error(f"Payment gateway unavailable: {str(e)}")
+            raise
         except Exception as e:
             logger.error(f"Payment creation failed: {str(e)}")
             return False
@@ -83,18 +270,14 @@ class PaymentProcessor:
         amount: float,
         currency: str = "RUB"
     ):
-        """Create refund for existing payment"""
+        """Create refund for existing payment.
+        Raises GatewayUnavailable if the gateway kept failing transiently."""
         idempotence_key = str(uuid.uuid4())
-        payload = {
-            "payment_id": payment_id,
-            "amount": {
-                "value": f"{amount:.2f}",
-                "currency": currency
-            }
-        }
+        payload = self.refund_payload(payment_id, amount, currency)
 
         try:
-            refund = Refund.create(payload, idempotence_key)
+            refund = self.with_retries(
+                "refunds", lambda: Refund.create(payload, idempotence_key))
             logger.info(f"Created refund {refund.id}")
             return {
                 "id": refund.id,
@@ -102,10 +285,160 @@ class PaymentProcessor:
                 "status": refund.status,
                 "amount": refund.amount.value
             }
+        except GatewayUnavailable as e:
+            logger.error(f"Payment gateway unavailable: {str(e)}")
+            raise
         except Exception as e:
             logger.error(f"Refund creation failed: {str(e)}")
             return e
 
+    def get_payment(self, payment_id: str) -> dict:
+        """Платёж в том виде, в каком его присылает вебхук (объект YooKassa API)"""
+        return dict(self.with_retries("payments", lambda: Payment.find_one(payment_id)))
+
+    def get_refund(self, refund_id: str) -> dict:
+        return dict(self.with_retries("refunds", lambda: Refund.find_one(refund_id)))
+
+
+class AsyncPaymentProcessor(PaymentProcessor):
+    """Те же запросы к YooKassa API, но через общий keep-alive httpx.AsyncClient,
+    чтобы не блокировать event loop в FastAPI обработчиках"""
+    def __init__(self, shop_id: str, api_key: str, base_url: str,
+                 max_rps: float = None, rate_limiter: RateLimiter = None,
+                 retries: int = 3, backoff_base: float = 0.5, backoff_max: float = 10,
+                 circuit_breaker: CircuitBreaker = None,
+                 max_concurrent: int = 50, bulkhead_timeout: float = 5,
+                 max_connections: int = 100, timeout: float = 30):
+        super().__init__(shop_id, api_key, base_url, max_rps, rate_limiter,
+                         retries, backoff_base, backoff_max, circuit_breaker,
+                         max_concurrent, bulkhead_timeout)
+        self.bulkheads = {op: asyncio.Semaphore(max_concurrent) for op in OPERATIONS}
+        self.client = httpx.AsyncClient(
+            base_url=YOOKASSA_API_URL,
+            auth=(shop_id, api_key),
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_connections),
+        )
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def _post(self, operation: str, payload: dict, idempotence_key: str) -> dict:
+        return await self._send(operation, lambda: self.client.post(
+            f"/{operation}", json=payload, headers={"Idempotence-Key": idempotence_key}))
+
+    async def _get(self, operation: str, object_id: str) -> dict:
+        return await self._send(operation, lambda: self.client.get(f"/{operation}/{object_id}"))
+
+    async def _send(self, operation: str, request) -> dict:
+        """request() - корутина с HTTP запросом; повторяется при временных ошибках"""
+        try:
+            # wait_for в 3.11 может потерять слот, если таймаут совпал с acquire
+            async with asyncio.timeout(self.bulkhead_timeout):
+                await self.bulkheads[operation].acquire()
+        except TimeoutError:
+            raise GatewayBusy(f"Too many concurrent {operation} requests")
+        self.track_in_flight(operation, 1)
+        try:
+            for attempt in range(self.retries + 1):
+                if not self.circuit_breaker.allow():
+                    raise CircuitOpen("Payment gateway circuit is open")
+                if self.rate_limiter:
+                    with tracing.span("gateway.rate_limit"):
+                        await self.rate_limiter.acquire_async()
+                start = time.perf_counter()
+                try:
+                    with tracing.span(f"gateway.{operation}"):
+                        response = await request()
+                    if response.status_code in TRANSIENT_HTTP_CODES:
+                        # в т.ч. 202 "запрос в обработке": raise_for_status на 2xx молчит
+                        raise httpx.HTTPStatusError(
+                            f"Transient gateway response {response.status_code}",
+                            request=response.request, response=response)
+                    response.raise_for_status()
+                except Exception as e:
+                    GATEWAY_LATENCY.observe(time.perf_counter() - start,
+                                            operation=operation, outcome="error")
+                    await asyncio.sleep(self.check_transient(e, attempt))
+                    continue
+                GATEWAY_LATENCY.observe(time.perf_counter() - start,
+                                        operation=operation, outcome="ok")
+                self.circuit_breaker.record_success()
+                return response.json()
+        finally:
+            self.track_in_flight(operation, -1)
+            self.bulkheads[operation].release()
+
+    async def create_payment(
+            self,
+            amount: float,
+            currency: str,
+            description: str,
+            chat_id: str,
+            start_recurrent: bool = False,
+            payment_method_id: str = None, # after recurrent this is saved
+            return_url: str = None,
+            metadata=None,
+            idempotence_key: str = None,
+    ):
+        """Create payment with optional recurrent setup.
+        Raises GatewayUnavailable if the gateway kept failing transiently."""
+        idempotence_key = idempotence_key or str(uuid.uuid4())
+        payload = self.payment_payload(
+            amount, currency, description, chat_id, start_recurrent,
+            payment_method_id, return_url, metadata)
+
+        try:
+            payment = await self._post("payments", payload, idempotence_key)
+            logger.info(f"Created payment {payment}")
+            return {
+                "id": payment["id"],
+                "status": payment["status"],
+                "confirmation_url": payment["confirmation"]["confirmation_url"] if not payment_method_id else None,
+                "payment_method_id": payment.get("payment_method", {}).get("id")
+            }
+        except GatewayUnavailable as e:
+            logger.error(f"Payment gateway unavailable: {str(e)}")
+            raise
+        except Exception as e:
+            logger.error(f"Payment creation failed: {str(e)}")
+            return False
+
+    async def refund_payment(
+        self,
+        payment_id: str,
+        amount: float,
+        currency: str = "RUB"
+    ):
+        """Create refund for existing payment.
+        Raises GatewayUnavailable if the gateway kept failing transiently."""
+        idempotence_key = str(uuid.uuid4())
+        payload = self.refund_payload(payment_id, amount, currency)
+
+        try:
+            refund = await self._post("refunds", payload, idempotence_key)
+            logger.info(f"Created refund {refund['id']}")
+            return {
+                "id": refund["id"],
+                "payment_id": refund["payment_id"],
+                "status": refund["status"],
+                "amount": refund["amount"]["value"]
+            }
+        except GatewayUnavailable as e:
+            logger.error(f"Payment gateway unavailable: {str(e)}")
+            raise
+        except Exception as e:
+            logger.error(f"Refund creation failed: {str(e)}")
+            return e
+
+    async def get_payment(self, payment_id: str) -> dict:
+        """Платёж в том виде, в каком его присылает вебхук (объект YooKassa API)"""
+        return await self._get("payments", payment_id)
+
+    async def get_refund(self, refund_id: str) -> dict:
+        return await self._get("refunds", refund_id)
+
 # Example usage
 if __name__ == '__main__':
     # Configuration